@@ -2,12 +2,17 @@
 Main entrypoint of the app
 """
 
+import argparse
+import asyncio
+import copy
 import os
 import sys
 import sqlite3
+import threading
+import time
 import traceback
-import uuid
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 import json
@@ -17,13 +22,25 @@ from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
 from langgraph.errors import GraphRecursionError
 
-from src.llm.langgraph.email_recon.assistant import EmailReconInvoicingAssistant
-from src.llm.langgraph.tool_based_recon.assistant import (
-    ToolBasedEmailReconInvoicingAssistant,
+from src.llm.agents.email_agent.attachment_dedup import (
+    AttachmentIndexer,
+    DuplicateChecker,
 )
-from src.data.db.db_scripts import query_sqlite_db, set_db
+from src.llm.agents.email_agent.fast_path import FastPathReconciler
+from src.llm.agents.email_agent.image_prep import ocr_input_stats
+from src.llm.agents.email_agent.pre_ocr import AttachmentTextExtractor
+from src.llm.langgraph.base import LangGraphQuery
+from src.llm.langgraph.factory import get_invoicing_assistant
+from src.data.db.connection_pool import get_connection
+from src.data.db.csv_sync import DatasetWatcher
+from src.data.db.db_scripts import dataset_tables, query_sqlite_db, set_db
+from src.data.db.invoice_index import invoice_index_reports
+from src.data.db.email_queue import EmailWorkQueue
+from src.data.db.ocr_cache import get_ocr_cache
+from src.data.db.status_writer import EmailStatusWriter, update_email_rows
 from src.misc.beautified_logging import BeautifiedLogging
 from src.misc.path_parser import get_db_path
+from src.misc.tracing import close_tracing, configure_tracing, span
 
 from typing import Any
 
@@ -34,6 +51,9 @@ sys.path.insert(0, f"{cwd}/src")
 
 load_dotenv(override=False)
 
+# emails picked up again when resuming a run, the other statuses are final
+RESUMABLE_STATUSES = ["NOT_STARTED", "API_ERROR", "RECURSION_LIMIT_REACHED"]
+
 
 class ReconApp:
     """
@@ -46,6 +66,8 @@ class ReconApp:
 
     transaction_db_path = f"{sqlite_path}/transactions.db"
     email_db_path = f"{sqlite_path}/emails.db"
+    checkpoint_db_path = f"{sqlite_path}/checkpoints.db"
+    span_db_path = f"{sqlite_path}/spans.db"
 
     logging = BeautifiedLogging()
 
@@ -56,9 +78,26 @@ class ReconApp:
         finance_clerk_model: str = os.environ["FINANCE_CLERK_MODEL"],
         vision_model: str = os.environ["VISION_MODEL"],
         max_retries: int = 3,
+        retry_backoff: float = 1,
         batch_size: int = 10,
         tool_based: bool = False,
         reset_db_state: bool = False,
+        sync_db_state: bool = False,
+        watch_dataset: bool = False,
+        workers: int = 1,
+        async_mode: bool = False,
+        queue: bool = False,
+        lease_seconds: float = 600,
+        resume: bool = False,
+        flush_rows: int = 50,
+        flush_ms: float = 200,
+        fast_path: bool = False,
+        trace: bool = False,
+        trace_file: str = None,
+        pre_ocr: bool = False,
+        pre_ocr_workers: int = 8,
+        dedup: bool = False,
+        dedup_max_distance: int = 24,
     ):
 
         self.supervisor_model = supervisor_model
@@ -67,14 +106,58 @@ class ReconApp:
         self.vision_model = vision_model
 
         self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
         self.batch_size = batch_size
 
         self.tool_based = tool_based
+        self.workers = max(workers, 1)
+        self.async_mode = async_mode
+        self.resume = resume
+        self.trace = trace
+        self.trace_file = trace_file
+        self.pre_ocr = pre_ocr
+        self.pre_ocr_workers = pre_ocr_workers
+        self.dedup = dedup
+        self.dedup_max_distance = dedup_max_distance
+        self.duplicates = None
 
         self.__reset_data()
 
-        set_db(reset=reset_db_state)
-        self.conn = sqlite3.connect(self.email_db_path)
+        set_db(reset=reset_db_state, sync=sync_db_state)
+        # rows written to the dataset CSVs during the run are synced in
+        self.dataset_watcher = (
+            DatasetWatcher(dataset_tables()) if watch_dataset else None
+        )
+        if reset_db_state:
+            self.__reset_checkpoints()
+        # status write-back is shared by the worker threads, on the pooled
+        # connection of this thread, the emails are streamed on another one
+        self.conn = get_connection(self.email_db_path)
+        self.db_lock = threading.Lock()
+
+        # emails are claimed from a shared work queue instead of a query,
+        # so several processes can run against the same emails.db
+        self.queue = (
+            EmailWorkQueue(
+                self.email_db_path,
+                lease_seconds=lease_seconds,
+                claim_statuses=RESUMABLE_STATUSES if resume else ["NOT_STARTED"],
+            )
+            if queue
+            else None
+        )
+
+        # emails with an unambiguous invoice are reconciled without the graph
+        self.fast_path = (
+            FastPathReconciler(self.transaction_db_path) if fast_path else None
+        )
+
+        # results are saved in batches by a single writer thread
+        self.status_writer = EmailStatusWriter(
+            self.__write_email_statuses,
+            batch_size=flush_rows,
+            flush_interval_ms=flush_ms,
+        )
 
     def __reset_data(self):
         self.base_result_data = {
@@ -98,10 +181,22 @@ class ReconApp:
             "output_token_details": {"audio": 0, "reasoning": 0},
         }
 
+    def __reset_checkpoints(self):
+        # checkpoints are kept by email_id, so they would resume stale runs
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(f"{self.checkpoint_db_path}{suffix}"):
+                os.remove(f"{self.checkpoint_db_path}{suffix}")
+
+    def __new_result_data(self) -> dict[str, Any]:
+        """Fresh result data so that emails never share usage counters"""
+        return copy.deepcopy(self.base_result_data)
+
     def __get_emails_in_batches(self, query: str) -> list[str]:
         try:
-            # Connect to the SQLite database
-            cursor = self.conn.cursor()
+            # Connect to the SQLite database, read-only and apart from the
+            # status writes, so the cursor reads the emails as they were
+            # when the query started while their statuses are updated
+            cursor = get_connection(self.email_db_path, read_only=True).cursor()
 
             # Execute the query
             cursor.execute(query)
@@ -115,10 +210,6 @@ class ReconApp:
 
         except sqlite3.Error as e:
             print(f"An error occurred: {e}")
-        finally:
-            # Close the connection
-            if self.conn:
-                self.conn.close()
 
     def __parse_timing(self, start_time: datetime) -> str:
         end_time = datetime.now()
@@ -203,8 +294,6 @@ class ReconApp:
         usage: dict[str:Any],
         chat_history: list[AIMessage, HumanMessage, ToolMessage],
     ):
-        cursor = self.conn.cursor()
-
         data_to_save = {
             **usage,
             **self.__parse_timing(start_time),
@@ -221,136 +310,270 @@ class ReconApp:
                     "API_ERROR"
                     if "EXCEPTION" in response
                     else (
-                        "NOT_INVOICE"
-                        if "NA" in response
-                        else "ERROR" if "ERROR" in response else "SUCCESS"
+                        "DUPLICATE"
+                        if response.startswith("DUPLICATE")
+                        else (
+                            "NOT_INVOICE"
+                            if "NA" in response
+                            else "ERROR" if "ERROR" in response else "SUCCESS"
+                        )
                     )
                 )
             ),
         }
 
-        set_clause = ", ".join(f"{key} = ?" for key in data_to_save.keys())
-        where_clause = f"""
-            WHERE email_id = "{email_id}"
-        """
-        update_query = f"UPDATE emails SET {set_clause} {where_clause}"
-
-        parameters = list(data_to_save.values())
-
-        cursor.execute(update_query, parameters)
-        self.conn.commit()
+        self.status_writer.put(email_id, data_to_save)
+
+    def __write_email_statuses(self, rows: list[tuple[str, dict[str, Any]]]):
+        if self.queue is not None:
+            self.queue.complete_many(rows)
+            return
+
+        with self.db_lock, span("save_email_statuses", "db", rows=len(rows)):
+            update_email_rows(self.conn, rows)
+
+    def __get_invoicing_assistant(self) -> LangGraphQuery:
+        # the assistant is compiled once and shared, only the chat is per email
+        return get_invoicing_assistant(
+            supervisor_model=self.supervisor_model,
+            sql_model=self.sql_model,
+            finance_clerk_model=self.finance_clerk_model,
+            vision_model=self.vision_model,
+            transaction_db_path=self.transaction_db_path,
+            tool_based=self.tool_based,
+            checkpoint_db_path=self.checkpoint_db_path,
+        )
 
-    def __email_recon(self, email: str) -> dict[str, Any]:
-        try:
-            attachments = f"Attachment: {email[5]}" if email[5] else ""
+    def __recon_query(self, email: str) -> str:
+        attachments = f"Attachment: {email[5]}" if email[5] else ""
 
-            email_data_string = f"""
+        email_data_string = f"""
             Sender: {email[1]}
             Subject: {email[3]}
             Body: {email[4]}
             {attachments}
             """
 
-            chat_id = str(uuid.uuid4())
-            invoicing_asst = None
-
-            if self.tool_based:
-                invoicing_asst = ToolBasedEmailReconInvoicingAssistant(
-                    supervisor_model=self.supervisor_model,
-                    sql_model=self.sql_model,
-                    finance_clerk_model=self.finance_clerk_model,
-                    vision_model=self.vision_model,
-                    transaction_db_path=self.transaction_db_path,
-                )
-            else:
-                invoicing_asst = EmailReconInvoicingAssistant(
-                    supervisor_model=self.supervisor_model,
-                    sql_model=self.sql_model,
-                    finance_clerk_model=self.finance_clerk_model,
-                    vision_model=self.vision_model,
-                    transaction_db_path=self.transaction_db_path,
-                )
-
-            response = invoicing_asst.generate_response(
-                f"""
+        return f"""
                 Help to reconcile invoices using the following email:
 
                 {email_data_string}
-                """,
-                chat_id,
-            )
+                """
 
-            usage = invoicing_asst.check_usage()
+    def __recon_result(
+        self,
+        invoicing_asst: LangGraphQuery,
+        chat_id: str,
+        status: str,
+        response: str,
+    ) -> dict[str, Any]:
+        return_data = {
+            **self.__new_result_data(),
+            "status": status,
+            "response": response,
+        }
+        if invoicing_asst is not None:
+            usage = invoicing_asst.check_usage(chat_id)
             chat_history = invoicing_asst.get_chat_history(chat_id)
-            return {
-                "status": "DONE",
-                "response": response,
-                "usage": usage,
-                "chat_history": chat_history,
-            }
+            invoicing_asst.release_chat(chat_id)
+
+            return_data["chat_history"] = chat_history
+            return_data["usage"] = usage
+
+        return return_data
+
+    def __duplicate_recon(self, email: str) -> dict[str, Any]:
+        return self.duplicates.check(
+            email_text=self.__recon_query(email),
+            subject=email[3],
+            body=email[4],
+            attachment=email[5],
+        )
+
+    def __fast_path_recon(self, email: str) -> dict[str, Any]:
+        return self.fast_path.reconcile(
+            email_text=self.__recon_query(email),
+            subject=email[3],
+            body=email[4],
+            attachment=email[5],
+        )
+
+    def __email_recon(self, email: str) -> dict[str, Any]:
+        # retries resume the checkpointed run of the email
+        chat_id = email[0]
+        invoicing_asst = None
+        try:
+            invoicing_asst = self.__get_invoicing_assistant()
+            response = invoicing_asst.generate_response(
+                self.__recon_query(email), chat_id
+            )
+            return self.__recon_result(invoicing_asst, chat_id, "DONE", response)
         except GraphRecursionError as e:
             print(f"GraphRecursionError occurred: {e}")
             traceback.print_exc()
 
-            return_data = {
-                **self.base_result_data,
-                "status": "RECURSION ERROR",
-                "response": f"RECURSION ERROR: {e}",
-            }
-            if invoicing_asst is not None:
-                usage = invoicing_asst.check_usage()
-                chat_history = invoicing_asst.get_chat_history(chat_id)
+            return self.__recon_result(
+                invoicing_asst, chat_id, "RECURSION ERROR", f"RECURSION ERROR: {e}"
+            )
+        except Exception as e:
+            print(f"Exception occurred: {e}")
+            traceback.print_exc()
+
+            return self.__recon_result(
+                invoicing_asst, chat_id, "EXCEPTION", f"EXCEPTION: {e}"
+            )
 
-                return_data["chat_history"] = chat_history
-                return_data["usage"] = usage
+    async def __aemail_recon(self, email: str) -> dict[str, Any]:
+        # retries resume the checkpointed run of the email
+        chat_id = email[0]
+        invoicing_asst = None
+        try:
+            invoicing_asst = self.__get_invoicing_assistant()
+            response = await invoicing_asst.agenerate_response(
+                self.__recon_query(email), chat_id
+            )
+            return self.__recon_result(invoicing_asst, chat_id, "DONE", response)
+        except GraphRecursionError as e:
+            print(f"GraphRecursionError occurred: {e}")
+            traceback.print_exc()
 
-            return return_data
+            return self.__recon_result(
+                invoicing_asst, chat_id, "RECURSION ERROR", f"RECURSION ERROR: {e}"
+            )
         except Exception as e:
             print(f"Exception occurred: {e}")
             traceback.print_exc()
 
-            return_data = {
-                **self.base_result_data,
-                "status": "EXCEPTION",
-                "response": f"EXCEPTION: {e}",
-            }
-            if invoicing_asst is not None:
-                usage = invoicing_asst.check_usage()
-                chat_history = invoicing_asst.get_chat_history(chat_id)
-
-                return_data["chat_history"] = chat_history
-                return_data["usage"] = usage
-            return return_data
-
-    def __parse_emails(self, query: str):
-        for email_list in self.__get_emails_in_batches(query):
-            for email in email_list:
-                start_time = datetime.now()
-                retry_count = 0
-                recon_state = {**self.base_result_data}
-                while recon_state["status"] not in ["DONE", "RECUSTION ERROR"]:
-                    new_recon_state = self.__email_recon(email)
-                    recon_state["status"] = new_recon_state["status"]
-                    recon_state["response"] = new_recon_state["response"]
-                    recon_state["chat_history"] += new_recon_state["chat_history"]
-                    for key in recon_state["usage"]:
-                        recon_state["usage"][key] += new_recon_state["usage"].get(
-                            key, 0
-                        )
+            return self.__recon_result(
+                invoicing_asst, chat_id, "EXCEPTION", f"EXCEPTION: {e}"
+            )
 
-                    # retry max_retries times else set to api error
-                    if retry_count == self.max_retries:
-                        break
-                    retry_count += 1
-
-                self.__update_email_status(
-                    email_id=email[0],
-                    start_time=start_time,
-                    response=recon_state["response"],
-                    usage=recon_state["usage"],
-                    chat_history=recon_state["chat_history"],
+    def __merge_recon_state(
+        self, recon_state: dict[str, Any], new_recon_state: dict[str, Any]
+    ):
+        recon_state["status"] = new_recon_state["status"]
+        recon_state["response"] = new_recon_state["response"]
+        recon_state["chat_history"] += new_recon_state["chat_history"]
+        for key in recon_state["usage"]:
+            recon_state["usage"][key] += new_recon_state["usage"].get(key, 0)
+
+    def __save_recon_state(
+        self, email: str, start_time: datetime, recon_state: dict[str, Any]
+    ):
+        self.__update_email_status(
+            email_id=email[0],
+            start_time=start_time,
+            response=recon_state["response"],
+            usage=recon_state["usage"],
+            chat_history=recon_state["chat_history"],
+        )
+
+    def __retry_delay(self, retry_count: int) -> float:
+        # exponential backoff between the retries of an email
+        return self.retry_backoff * 2**retry_count
+
+    def __process_email(self, email: str):
+        with span("email", "email", trace_id=email[0], email_id=email[0]):
+            start_time = datetime.now()
+            retry_count = 0
+            recon_state = self.__new_result_data()
+            if self.duplicates is not None:
+                self.__merge_recon_state(recon_state, self.__duplicate_recon(email))
+            if self.fast_path is not None and recon_state["status"] != "DONE":
+                self.__merge_recon_state(recon_state, self.__fast_path_recon(email))
+
+            while recon_state["status"] not in ["DONE", "RECURSION ERROR"]:
+                self.__merge_recon_state(recon_state, self.__email_recon(email))
+
+                # retry max_retries times else set to api error
+                if (
+                    recon_state["status"] in ["DONE", "RECURSION ERROR"]
+                    or retry_count == self.max_retries
+                ):
+                    break
+                time.sleep(self.__retry_delay(retry_count))
+                retry_count += 1
+
+            self.__save_recon_state(email, start_time, recon_state)
+
+            # the checkpoints of an api error are kept to resume it in a later run
+            if recon_state["status"] != "EXCEPTION":
+                self.__get_invoicing_assistant().delete_checkpoints(email[0])
+
+    async def __aprocess_email(self, email: str):
+        with span("email", "email", trace_id=email[0], email_id=email[0]):
+            start_time = datetime.now()
+            retry_count = 0
+            recon_state = self.__new_result_data()
+            if self.duplicates is not None:
+                self.__merge_recon_state(
+                    recon_state, await asyncio.to_thread(self.__duplicate_recon, email)
+                )
+            if self.fast_path is not None and recon_state["status"] != "DONE":
+                self.__merge_recon_state(
+                    recon_state, await asyncio.to_thread(self.__fast_path_recon, email)
                 )
-                self.__reset_data()
+
+            while recon_state["status"] not in ["DONE", "RECURSION ERROR"]:
+                self.__merge_recon_state(recon_state, await self.__aemail_recon(email))
+
+                # retry max_retries times else set to api error
+                if (
+                    recon_state["status"] in ["DONE", "RECURSION ERROR"]
+                    or retry_count == self.max_retries
+                ):
+                    break
+                await asyncio.sleep(self.__retry_delay(retry_count))
+                retry_count += 1
+
+            # keep parsing the chat history off the event loop
+            await asyncio.to_thread(self.__save_recon_state, email, start_time, recon_state)
+
+            # the checkpoints of an api error are kept to resume it in a later run
+            if recon_state["status"] != "EXCEPTION":
+                await self.__get_invoicing_assistant().adelete_checkpoints(email[0])
+
+    def __parse_emails(self, email_batches):
+        if self.workers == 1:
+            for email_list in email_batches:
+                for email in email_list:
+                    self.__process_email(email)
+            return
+
+        # keep a bounded number of emails queued ahead of the workers
+        max_in_flight = self.workers * 2
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="recon"
+        ) as executor:
+            in_flight = set()
+            for email_list in email_batches:
+                for email in email_list:
+                    if len(in_flight) >= max_in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    in_flight.add(executor.submit(self.__process_email, email))
+
+            for future in wait(in_flight).done:
+                future.result()
+
+    async def __aparse_emails(self, email_batches):
+        # workers caps the number of emails in flight on the event loop, the
+        # next batch is only pulled, or claimed with --queue, once one is done
+        in_flight = set()
+        for email_list in email_batches:
+            for email in email_list:
+                if len(in_flight) >= self.workers:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                in_flight.add(asyncio.create_task(self.__aprocess_email(email)))
+
+        if in_flight:
+            for task in (await asyncio.wait(in_flight))[0]:
+                task.result()
 
     def __evaluate(self):
         """
@@ -361,6 +584,7 @@ class ReconApp:
             """
             SELECT COUNT(*) FROM transactions WHERE reconciliation_state = "UNPAID"
             """,
+            read_only=True,
         )
         self.logging.info(
             "User",
@@ -376,6 +600,7 @@ class ReconApp:
             """
             SELECT COUNT(*) FROM emails WHERE process_status = "NOT_STARTED"
             """,
+            read_only=True,
         )
         self.logging.info(
             "User",
@@ -386,24 +611,178 @@ class ReconApp:
             """,
         )
 
+    def __resume_query(self, query: str) -> str:
+        """
+        Restrict the query to the emails that are not reconciled yet
+        and report how many are skipped
+        """
+        statuses = ", ".join([f"'{status}'" for status in RESUMABLE_STATUSES])
+        status_counts = query_sqlite_db(
+            self.email_db_path,
+            f"""
+            SELECT process_status, COUNT(*) FROM ({query}) GROUP BY process_status
+            """,
+            read_only=True,
+        )
+
+        to_process = {k: v for k, v in status_counts if k in RESUMABLE_STATUSES}
+        skipped = {k: v for k, v in status_counts if k not in RESUMABLE_STATUSES}
+        self.logging.info(
+            "User",
+            f"""
+            Resuming run
+
+            To process: {sum(to_process.values())} {to_process}
+            Skipped: {sum(skipped.values())} {skipped}
+            """,
+        )
+
+        return f"SELECT * FROM ({query}) WHERE process_status IN ({statuses})"
+
     def run(self, query: str = "SELECT * FROM emails"):
         """
         Run service
         """
         self.__evaluate()
-        self.__parse_emails(query)
+
+        if self.trace:
+            configure_tracing(self.span_db_path, self.trace_file)
+
+        if self.resume and self.queue is None:
+            query = self.__resume_query(query)
+
+        # duplicates are indexed first so that they share one OCR result
+        if self.dedup:
+            AttachmentIndexer(
+                self.email_db_path,
+                f"{os.getcwd()}/dataset/attachments",
+                max_distance=self.dedup_max_distance,
+            ).run()
+            self.duplicates = DuplicateChecker(
+                self.email_db_path, self.transaction_db_path
+            )
+
+        # the attachments are OCRed up front, the graph reads their text
+        if self.pre_ocr:
+            AttachmentTextExtractor(
+                self.email_db_path, workers=self.pre_ocr_workers
+            ).run()
+
+        if self.queue is not None:
+            self.logging.info(
+                "User", f"Claiming emails as worker {self.queue.worker_id}"
+            )
+            self.queue.start()
+            email_batches = self.queue.claim_in_batches(self.batch_size)
+        else:
+            email_batches = self.__get_emails_in_batches(query)
+
+        if self.dataset_watcher is not None:
+            self.dataset_watcher.start()
+
+        self.status_writer.start()
+        try:
+            if self.async_mode:
+                asyncio.run(self.__aparse_emails(email_batches))
+            else:
+                self.__parse_emails(email_batches)
+        finally:
+            # flush the results before the leases are released
+            self.status_writer.close()
+            if self.queue is not None:
+                self.queue.stop()
+            if self.dataset_watcher is not None:
+                self.dataset_watcher.stop()
+            if self.trace:
+                close_tracing()
+
+        if self.duplicates is not None:
+            self.logging.info("User", self.duplicates.report())
+
+        if self.fast_path is not None:
+            self.logging.info("User", self.fast_path.report())
+
+        ocr_cache = get_ocr_cache()
+        if ocr_cache is not None:
+            self.logging.info("User", ocr_cache.report())
+
+        if ocr_input_stats.models:
+            self.logging.info("User", ocr_input_stats.report())
+
+        for report in invoice_index_reports():
+            self.logging.info("User", report)
+
         self.__evaluate()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the reconciliation agent")
+    parser.add_argument(
+        "query", nargs="?", default=None, help='SQL query, i.e. "SELECT * FROM emails"'
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("RECON_WORKERS", "1")),
+        help="Number of emails to reconcile concurrently",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_mode",
+        action="store_true",
+        default=os.getenv("RECON_ASYNC") == "true",
+        help="Run the emails as asyncio tasks on one event loop instead of threads",
+    )
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        default=os.getenv("RECON_QUEUE") == "true",
+        help="Claim emails from the shared work queue, ignores the SQL query",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=os.getenv("RECON_RESUME") == "true",
+        help="Only process emails that are NOT_STARTED or failed with a retryable error",
+    )
+    parser.add_argument(
+        "--fast-path",
+        action="store_true",
+        default=os.getenv("RECON_FAST_PATH") == "true",
+        help="Reconcile unambiguous emails with rules before running the graph",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        default=os.getenv("RECON_TRACE") == "true",
+        help="Record spans of the emails, graph nodes, LLM requests, tools and db queries",
+    )
+    parser.add_argument(
+        "--pre-ocr",
+        action="store_true",
+        default=os.getenv("RECON_PRE_OCR") == "true",
+        help="OCR all the attachments before reconciling the emails",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        default=os.getenv("RECON_DEDUP") == "true",
+        help="Share the OCR of duplicate attachments and flag duplicates of paid invoices",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=os.getenv("RECON_WATCH_DATASET") == "true",
+        help="Sync the rows written to the dataset CSVs during the run",
+    )
+    args = parser.parse_args()
+
     max_entries = os.getenv("MAX_ENTRIES")
     SYS_SQL_QUERY = "SELECT * FROM emails"
     if max_entries:
         SYS_SQL_QUERY = f"{SYS_SQL_QUERY} LIMIT {max_entries}"
-    if len(sys.argv) > 1:
-        cmd_args = sys.argv[1]
-        if cmd_args.startswith("SELECT "):
-            SYS_SQL_QUERY = cmd_args
+    if args.query and args.query.startswith("SELECT "):
+        SYS_SQL_QUERY = args.query
 
     ReconApp(
         supervisor_model=os.environ["SUPERVISOR_MODEL"],
@@ -413,7 +792,24 @@ if __name__ == "__main__":
         max_retries=int(
             os.getenv("MAX_RETRIES", "3")
         ),
+        retry_backoff=float(os.getenv("RETRY_BACKOFF_SECONDS", "1")),
         batch_size=10,
         tool_based=True,
         reset_db_state=os.getenv("RESET_DB_STATE") == "true",
+        sync_db_state=os.getenv("SYNC_DB_STATE") == "true",
+        watch_dataset=args.watch,
+        workers=args.workers,
+        async_mode=args.async_mode,
+        queue=args.queue,
+        lease_seconds=float(os.getenv("RECON_LEASE_SECONDS", "600")),
+        resume=args.resume,
+        flush_rows=int(os.getenv("STATUS_FLUSH_ROWS", "50")),
+        flush_ms=float(os.getenv("STATUS_FLUSH_MS", "200")),
+        fast_path=args.fast_path,
+        trace=args.trace,
+        trace_file=os.getenv("RECON_TRACE_FILE"),
+        pre_ocr=args.pre_ocr,
+        pre_ocr_workers=int(os.getenv("PRE_OCR_WORKERS", "8")),
+        dedup=args.dedup,
+        dedup_max_distance=int(os.getenv("DEDUP_MAX_DISTANCE", "24")),
     ).run(SYS_SQL_QUERY)
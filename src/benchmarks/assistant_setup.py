@@ -0,0 +1,80 @@
+"""
+Benchmark of the per email setup overhead of the invoicing assistants
+
+Compares building a new assistant for every email against
+reusing the assistant compiled once by the factory.
+No LLM requests are made, only the setup is timed
+
+Usage: python src/benchmarks/assistant_setup.py [num_emails] [--sql-agents]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(override=False)
+
+# model clients are only constructed, so placeholders are enough
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("MODEL", "gpt-4o-mini")
+
+from src.data.db.db_scripts import csv_to_sqlite
+from src.llm.langgraph.email_recon.assistant import EmailReconInvoicingAssistant
+from src.llm.langgraph.factory import get_invoicing_assistant
+from src.llm.langgraph.tool_based_recon.assistant import (
+    ToolBasedEmailReconInvoicingAssistant,
+)
+
+cwd = os.getcwd()
+
+
+def time_per_email(setup, num_emails: int) -> float:
+    """Mean setup time per email in milliseconds"""
+    start_time = time.perf_counter()
+    for _ in range(num_emails):
+        setup()
+    return (time.perf_counter() - start_time) * 1000 / num_emails
+
+
+if __name__ == "__main__":
+    num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tool_based = "--sql-agents" not in sys.argv
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        transaction_db_path = f"{tmp_dir}/transactions.db"
+        csv_to_sqlite(
+            f"{cwd}/dataset/transactions.csv", transaction_db_path, "transactions"
+        )
+
+        model = os.environ["MODEL"]
+        models = {
+            "supervisor_model": model,
+            "sql_model": model,
+            "finance_clerk_model": model,
+            "vision_model": model,
+            "transaction_db_path": transaction_db_path,
+        }
+        assistant_class = (
+            ToolBasedEmailReconInvoicingAssistant
+            if tool_based
+            else EmailReconInvoicingAssistant
+        )
+
+        before = time_per_email(lambda: assistant_class(**models), num_emails)
+        # the first call compiles the shared assistant
+        compile_time = time_per_email(
+            lambda: get_invoicing_assistant(**models, tool_based=tool_based), 1
+        )
+        after = time_per_email(
+            lambda: get_invoicing_assistant(**models, tool_based=tool_based),
+            num_emails,
+        )
+
+    print(f"Assistant: {assistant_class.__name__}")
+    print(f"Emails: {num_emails}")
+    print(f"Setup per email, new assistant per email:\t{before:.3f} ms")
+    print(f"One time compile of the shared assistant:\t{compile_time:.3f} ms")
+    print(f"Setup per email, shared compiled assistant:\t{after:.3f} ms")
@@ -0,0 +1,480 @@
+"""
+OpenAI compatible stand-in LLM server for load testing without a GPU or API key
+
+Serves /v1/chat/completions with scripted replies for the tool based
+reconciliation graph: tool calls for the finance clerk and the data engineers,
+QUERY / UPDATE / ERROR / NA replies for the senior reconciliation agent and
+OCR transcriptions of the dataset attachments for the vision requests,
+built from dataset/ground_truth.csv
+
+Latency, token counts and errors are configurable, request stats are served
+on /stats
+
+Usage: python src/benchmarks/fake_llm_server.py [--port 8010] [--latency 0.2]
+    [--error-rate 0.01] [--prompt-tokens N] [--completion-tokens N]
+
+Then point the app at it with
+    OPENAI_API_KEY=fake BASE_URL=http://127.0.0.1:8010/v1
+    VISION_BASE_URL=http://127.0.0.1:8010/v1
+"""
+
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+cwd = os.getcwd()
+
+INVOICE_ID_PATTERN = re.compile(r"Invoice ID\s*:?\s*#?\s*(\d+)", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)")
+JSON_AMOUNT_PATTERN = re.compile(r'"amount":\s*(\d[\d.]*)')
+DB_AMOUNT_PATTERN = re.compile(r"amount:\s*\$\s*(\d[\d,]*(?:\.\d+)?)")
+ATTACHMENT_PATTERN = re.compile(r"Attachment:\s*(\S+)")
+# labels of the query tool results in the chat history
+QUERY_TOOL_LABELS = ("Invoice Db Query Tool:", "Invoice Db Batch Query Tool:")
+
+# prompt tokens of an image, as for a low detail image on OpenAI
+IMAGE_TOKENS = 85
+
+
+def load_ocr_transcripts(dataset_path: str) -> dict[str, dict[str, str]]:
+    """
+    OCR transcriptions of the attachments keyed by the sha256 of the image,
+    as free-form text and as the JSON of the structured OCR mode
+    """
+    transcripts = {}
+    ground_truth_path = f"{dataset_path}/ground_truth.csv"
+    if not os.path.exists(ground_truth_path):
+        return transcripts
+
+    with open(ground_truth_path, newline="", encoding="utf-8") as ground_truth:
+        for row in csv.DictReader(ground_truth):
+            file_path = (
+                f"{dataset_path}/attachments/{os.path.basename(row['filename'])}"
+            )
+            if not os.path.exists(file_path):
+                continue
+
+            with open(file_path, "rb") as image_file:
+                image_hash = hashlib.sha256(image_file.read()).hexdigest()
+            transcripts[image_hash] = {
+                "text": "\n".join(
+                    [
+                        f"You paid ${float(row['amount']):g}",
+                        f"Invoice ID: {row['invoice_id']}",
+                        f"Transaction Reference Number: {row['transaction_id']}",
+                        f"Transaction Date: {row['transaction_date']}",
+                        f"Sent by: {row['sender_name']}",
+                    ]
+                ),
+                "json": json.dumps(
+                    {
+                        "invoice_id": row["invoice_id"],
+                        "amount": float(row["amount"]),
+                        "currency": "USD",
+                        "dates": [row["transaction_date"]],
+                        "payer": row["sender_name"],
+                        "payee": row["recipient_name"],
+                    }
+                ),
+            }
+    return transcripts
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count, about 4 characters per token"""
+    return max(len(text) // 4, 1)
+
+
+class FakeLLM:
+    """Scripted replies of the fake server"""
+
+    def __init__(
+        self,
+        dataset_path: str = f"{cwd}/dataset",
+        latency: float = 0.2,
+        jitter: float = 0,
+        error_rate: float = 0,
+        error_status: int = 500,
+        prompt_tokens: int = None,
+        completion_tokens: int = None,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+        self.random = random.Random(seed)
+        self.transcripts = load_ocr_transcripts(dataset_path)
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    def __ocr(self, messages: list[dict]) -> str:
+        for message in messages:
+            if not isinstance(message.get("content"), list):
+                continue
+            # the structured OCR prompt asks for the fields as JSON
+            output = (
+                "json"
+                if any("JSON" in part.get("text", "") for part in message["content"])
+                else "text"
+            )
+            for part in message["content"]:
+                if part.get("type") != "image_url":
+                    continue
+                url = part["image_url"]
+                url = url["url"] if isinstance(url, dict) else url
+                image = base64.b64decode(url.split(",", 1)[-1])
+                transcript = self.transcripts.get(hashlib.sha256(image).hexdigest())
+                return transcript[output] if transcript else "[unclear]"
+        return ""
+
+    def __reconcile(self, text: str) -> str:
+        """Reply of the senior reconciliation agent"""
+        query_label = next(
+            (label for label in QUERY_TOOL_LABELS if label in text), None
+        )
+        if query_label is not None:
+            query_result = text.rsplit(query_label, 1)[1]
+            if "No results" in query_result or "ERROR" in query_result:
+                return "ERROR the invoice is not in the database"
+
+            invoice_ids = INVOICE_ID_PATTERN.findall(text)
+            db_amounts = DB_AMOUNT_PATTERN.findall(query_result)
+            ocr_text = text.rsplit("Ocr Tool:", 1)[1] if "Ocr Tool:" in text else ""
+            ocr_amounts = AMOUNT_PATTERN.findall(ocr_text) or JSON_AMOUNT_PATTERN.findall(
+                ocr_text
+            )
+            if (
+                db_amounts
+                and ocr_amounts
+                and float(db_amounts[0].replace(",", ""))
+                == float(ocr_amounts[0].replace(",", ""))
+            ):
+                return f"UPDATE invoice ID: {invoice_ids[-1]}, the amount matches"
+            return "ERROR the invoice amount does not match"
+
+        invoice_ids = INVOICE_ID_PATTERN.findall(text)
+        if invoice_ids:
+            return f"QUERY invoice ID: {invoice_ids[-1]}"
+        return "NA the email is not about invoices"
+
+    def __tool_call(self, name: str, arguments: dict[str, Any]) -> dict:
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)},
+        }
+
+    def reply(self, body: dict) -> dict:
+        """Scripted assistant message for a chat completion request"""
+        messages = body.get("messages", [])
+        tools = [tool["function"]["name"] for tool in body.get("tools", [])]
+        text = "\n".join(
+            message["content"]
+            for message in messages
+            if isinstance(message.get("content"), str)
+        )
+        # the agents get the chat history or the latest message as the request
+        request = (
+            text.rsplit("Request:", 1)[1].split("Kindly do not assume")[0].strip()
+            if "Request:" in text
+            else text
+        )
+        invoice_ids = INVOICE_ID_PATTERN.findall(text)
+
+        ocr_text = self.__ocr(messages)
+        if ocr_text:
+            return {"role": "assistant", "content": ocr_text}
+
+        if "ocr_tool" in tools:
+            attachments = ATTACHMENT_PATTERN.findall(text)
+            if "Ocr Tool:" in text:
+                return {"role": "assistant", "content": "DONE"}
+            if not attachments:
+                return {"role": "assistant", "content": "NO ATTACHMENTS"}
+            return {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    self.__tool_call("ocr_tool", {"image_path": attachments[0]})
+                ],
+            }
+
+        if "invoice_db_query_tool" in tools or "invoice_db_batch_query_tool" in tools:
+            if request.startswith(QUERY_TOOL_LABELS):
+                return {"role": "assistant", "content": "DONE"}
+            if not invoice_ids:
+                return {"role": "assistant", "content": "ASK for the invoice ID"}
+            tool_call = (
+                self.__tool_call(
+                    "invoice_db_batch_query_tool",
+                    {"invoice_ids": list(dict.fromkeys(invoice_ids))},
+                )
+                if "invoice_db_batch_query_tool" in tools
+                else self.__tool_call(
+                    "invoice_db_query_tool", {"invoice_id": invoice_ids[-1]}
+                )
+            )
+            return {"role": "assistant", "content": "", "tool_calls": [tool_call]}
+
+        if "invoice_db_update_tool" in tools:
+            return {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    self.__tool_call(
+                        "invoice_db_update_tool",
+                        {
+                            "invoice_id": invoice_ids[-1] if invoice_ids else "",
+                            "email_details": request,
+                        },
+                    )
+                ],
+            }
+
+        return {"role": "assistant", "content": self.__reconcile(text)}
+
+    def usage(self, body: dict, message: dict) -> dict:
+        """Token usage of a reply, estimated unless fixed counts are configured"""
+        prompt_tokens = self.prompt_tokens
+        if not prompt_tokens:
+            prompt_tokens = 0
+            for message in body.get("messages", []):
+                content = message.get("content") or ""
+                parts = content if isinstance(content, list) else [{"text": content}]
+                for part in parts:
+                    prompt_tokens += (
+                        IMAGE_TOKENS
+                        if part.get("type") == "image_url"
+                        else count_tokens(part.get("text", ""))
+                    )
+        completion_tokens = self.completion_tokens or count_tokens(
+            message.get("content") or json.dumps(message.get("tool_calls", []))
+        )
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def delay(self) -> float:
+        """Latency of a request"""
+        with self.lock:
+            return max(self.latency + self.random.uniform(-1, 1) * self.jitter, 0)
+
+    def should_fail(self) -> bool:
+        """Whether to inject an error in a request"""
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """HTTP handler of the fake server"""
+
+    fake_llm: FakeLLM = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send_json(self, status: int, data: dict):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __send_stream(self, completion: dict, include_usage: bool):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        message = completion["choices"][0]["message"]
+        delta = {"role": "assistant", "content": message.get("content") or ""}
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [
+                {**tool_call, "index": index}
+                for index, tool_call in enumerate(message["tool_calls"])
+            ]
+
+        chunk = {
+            **{k: v for k, v in completion.items() if k not in ["choices", "usage"]},
+            "object": "chat.completion.chunk",
+        }
+        chunks = [
+            {**chunk, "choices": [{"index": 0, "delta": delta}]},
+            {
+                **chunk,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {},
+                        "finish_reason": completion["choices"][0]["finish_reason"],
+                    }
+                ],
+            },
+        ]
+        if include_usage:
+            chunks.append({**chunk, "choices": [], "usage": completion["usage"]})
+
+        for data in chunks:
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.fake_llm.lock:
+                self.__send_json(200, dict(self.fake_llm.stats))
+            return
+        if self.path.rstrip("/") == "/v1/models":
+            self.__send_json(200, {"object": "list", "data": []})
+            return
+        self.__send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.__send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        fake_llm = self.fake_llm
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        with fake_llm.lock:
+            fake_llm.stats["requests"] += 1
+            fake_llm.stats["in_flight"] += 1
+            fake_llm.stats["peak_in_flight"] = max(
+                fake_llm.stats["peak_in_flight"], fake_llm.stats["in_flight"]
+            )
+        try:
+            time.sleep(fake_llm.delay())
+
+            if fake_llm.should_fail():
+                with fake_llm.lock:
+                    fake_llm.stats["errors"] += 1
+                self.__send_json(
+                    fake_llm.error_status,
+                    {"error": {"message": "Injected error", "type": "server_error"}},
+                )
+                return
+
+            message = fake_llm.reply(body)
+            usage = fake_llm.usage(body, message)
+            with fake_llm.lock:
+                fake_llm.stats["prompt_tokens"] += usage["prompt_tokens"]
+                fake_llm.stats["completion_tokens"] += usage["completion_tokens"]
+
+            completion = {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": (
+                            "tool_calls" if message.get("tool_calls") else "stop"
+                        ),
+                    }
+                ],
+                "usage": usage,
+            }
+            if body.get("stream"):
+                self.__send_stream(
+                    completion,
+                    (body.get("stream_options") or {}).get("include_usage", False),
+                )
+            else:
+                self.__send_json(200, completion)
+        finally:
+            with fake_llm.lock:
+                fake_llm.stats["in_flight"] -= 1
+
+
+def create_server(
+    host: str = "127.0.0.1", port: int = 8010, **kwargs
+) -> ThreadingHTTPServer:
+    """Create the fake server, kwargs are passed to FakeLLM"""
+    handler = type(
+        "BoundFakeLLMHandler", (FakeLLMHandler,), {"fake_llm": FakeLLM(**kwargs)}
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument(
+        "--dataset", default=f"{cwd}/dataset", help="Dataset used for the OCR replies"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0,
+        help="Max seconds added to or removed from the latency",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of requests that fail"
+    )
+    parser.add_argument(
+        "--error-status", type=int, default=500, help="HTTP status of the failures"
+    )
+    parser.add_argument(
+        "--prompt-tokens",
+        type=int,
+        default=None,
+        help="Fixed prompt tokens per request",
+    )
+    parser.add_argument(
+        "--completion-tokens",
+        type=int,
+        default=None,
+        help="Fixed completion tokens per request",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake_server = create_server(
+        host=args.host,
+        port=args.port,
+        dataset_path=args.dataset,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        prompt_tokens=args.prompt_tokens,
+        completion_tokens=args.completion_tokens,
+        seed=args.seed,
+    )
+    print(f"Fake LLM server listening on http://{args.host}:{args.port}/v1")
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        fake_server.shutdown()
@@ -0,0 +1,231 @@
+"""
+End to end throughput benchmark of the reconciliation pipeline
+
+Runs ReconApp over a slice of the dataset against the fake LLM server, in a
+temporary working directory so the databases of the real runs are untouched,
+and writes the results as JSON:
+
+- emails per second
+- p50 / p95 / p99 latency per email
+- LLM turns and tokens per email
+- peak RSS of the process
+
+Usage: python src/benchmarks/throughput.py [--emails 50] [--workers 8] [--async]
+    [--fast-path] [--latency 0.05] [--error-rate 0] [--output throughput.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+repo_path = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+sys.path.insert(0, repo_path)
+
+# the stub models served by the fake server
+BENCHMARK_ENV = {
+    "OPENAI_API_KEY": "benchmark",
+    "MODEL": "fake",
+    "VISION_MODEL": "fake-vision",
+    "SUPERVISOR_MODEL": "fake",
+    "SQL_MODEL": "fake",
+    "FINANCE_CLERK_MODEL": "fake",
+}
+
+
+def free_port() -> int:
+    """Free local port for the fake server"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    """Start the fake LLM server in its own process and wait until it is up"""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            f"{repo_path}/src/benchmarks/fake_llm_server.py",
+            f"--port={port}",
+            f"--dataset={repo_path}/dataset",
+            f"--latency={args.latency}",
+            f"--error-rate={args.error_rate}",
+            f"--seed={args.seed}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            fake_server_stats(port)
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("Fake LLM server did not start")
+
+
+def fake_server_stats(port: int) -> dict:
+    """Request stats of the fake server"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=1) as res:
+        return json.loads(res.read())
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Nearest rank percentile"""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def run_benchmark(args: argparse.Namespace, port: int) -> dict:
+    """Run ReconApp over the slice of the dataset and collect the results"""
+    # imported once the environment points at the fake server
+    from app import ReconApp
+
+    query = f"SELECT * FROM emails LIMIT {args.emails} OFFSET {args.offset}"
+    app = ReconApp(
+        max_retries=args.max_retries,
+        retry_backoff=0,
+        tool_based=True,
+        reset_db_state=True,
+        workers=args.workers,
+        async_mode=args.async_mode,
+        fast_path=args.fast_path,
+    )
+
+    start_time = time.perf_counter()
+    app.run(query)
+    wall_time = time.perf_counter() - start_time
+
+    conn = sqlite3.connect(app.email_db_path)
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT process_status, total_time, successful_requests, total_tokens
+            FROM ({query})
+            """
+        ).fetchall()
+    finally:
+        conn.close()
+
+    statuses = {}
+    for status, *_ in rows:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    # the metrics columns are numeric, NULL for the unprocessed emails
+    latencies = [row[1] for row in rows if row[1] is not None]
+    turns = [row[2] or 0 for row in rows]
+    tokens = [row[3] or 0 for row in rows]
+    num_emails = len(rows)
+
+    return {
+        "emails": num_emails,
+        "statuses": statuses,
+        "wall_time_s": wall_time,
+        "emails_per_s": num_emails / wall_time if wall_time else 0,
+        "latency_s": {
+            "mean": sum(latencies) / len(latencies) if latencies else 0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=0),
+        },
+        "llm_turns_per_email": sum(turns) / num_emails if num_emails else 0,
+        "tokens_per_email": sum(tokens) / num_emails if num_emails else 0,
+        "peak_rss_mb": peak_rss_mb(),
+        "fake_server": fake_server_stats(port),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--emails", type=int, default=50, help="Emails to process")
+    parser.add_argument(
+        "--offset", type=int, default=0, help="First email of the slice"
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--async", dest="async_mode", action="store_true")
+    parser.add_argument("--fast-path", action="store_true")
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds per LLM request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of failed LLM requests"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default="throughput.json", help="JSON file for the results"
+    )
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+    port = free_port()
+    fake_server = start_fake_server(port, args)
+
+    os.environ.update(
+        {
+            **BENCHMARK_ENV,
+            "BASE_URL": f"http://127.0.0.1:{port}/v1",
+            "VISION_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        }
+    )
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the databases are built relative to the working directory
+            os.symlink(f"{repo_path}/dataset", f"{tmp_dir}/dataset")
+            os.chdir(tmp_dir)
+            results = run_benchmark(args, port)
+            os.chdir(repo_path)
+    finally:
+        fake_server.terminate()
+        fake_server.wait()
+
+    results = {
+        "benchmark": "throughput",
+        "timestamp": datetime.now().isoformat(),
+        "config": vars(args),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        **results,
+    }
+    with open(output_path, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2)
+
+    print(f"Emails:\t\t\t{results['emails']} {results['statuses']}")
+    print(f"Throughput:\t\t{results['emails_per_s']:.2f} emails/s")
+    print(
+        "Latency per email:\t"
+        f"p50 {results['latency_s']['p50']:.3f} s, "
+        f"p95 {results['latency_s']['p95']:.3f} s, "
+        f"p99 {results['latency_s']['p99']:.3f} s"
+    )
+    print(f"LLM turns per email:\t{results['llm_turns_per_email']:.2f}")
+    print(f"Tokens per email:\t{results['tokens_per_email']:.1f}")
+    print(f"Peak RSS:\t\t{results['peak_rss_mb']:.1f} MB")
+    print(f"Results written to {output_path}")
@@ -0,0 +1,68 @@
+"""
+Index of the attachments mapping the exact and near duplicates
+to the canonical attachment whose OCR result they share
+"""
+
+import sqlite3
+
+from src.data.db.connection_pool import get_connection
+
+TABLE_NAME = "attachment_index"
+
+
+def create_attachment_index_table(conn: sqlite3.Connection):
+    """Create the attachment_index table if missing"""
+    with conn:
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                attachment TEXT PRIMARY KEY,
+                sha256 TEXT,
+                dhash TEXT,
+                canonical TEXT,
+                duplicate_type TEXT
+            )
+            """
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {TABLE_NAME}_canonical ON {TABLE_NAME} (canonical)"
+        )
+
+
+def load_attachment_index(conn: sqlite3.Connection) -> dict[str, tuple]:
+    """Indexed attachments as attachment: (sha256, dhash, canonical, duplicate_type)"""
+    return {
+        row[0]: row[1:]
+        for row in conn.execute(
+            f"SELECT attachment, sha256, dhash, canonical, duplicate_type FROM {TABLE_NAME}"
+        )
+    }
+
+
+def save_attachment_index(conn: sqlite3.Connection, rows: list[tuple]):
+    """Save (attachment, sha256, dhash, canonical, duplicate_type) rows in one transaction"""
+    with conn:
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO {TABLE_NAME} (attachment, sha256, dhash, canonical, duplicate_type)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+
+
+def get_canonical_attachment(email_db_path: str, attachment: str) -> str:
+    """Canonical attachment of a duplicate, the attachment itself when it is not indexed"""
+    try:
+        row = (
+            get_connection(email_db_path, read_only=True)
+            .execute(
+                f"SELECT canonical FROM {TABLE_NAME} WHERE attachment = ?",
+                (attachment,),
+            )
+            .fetchone()
+        )
+    except sqlite3.OperationalError:
+        # no database yet, or the attachments were not indexed for it
+        return attachment
+    return row[0] if row else attachment
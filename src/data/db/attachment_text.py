@@ -0,0 +1,101 @@
+"""
+Precomputed OCR text of the attachments, stored next to the emails under
+the version of the OCR output they were extracted with
+"""
+
+import json
+import sqlite3
+import time
+from typing import Any
+
+from src.data.db.connection_pool import get_connection
+
+TABLE_NAME = "attachment_text"
+EMAIL_TABLE_NAME = "emails"
+
+
+def create_attachment_text_table(conn: sqlite3.Connection):
+    """Create the attachment_text table if missing"""
+    with conn:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")]
+        if columns and "ocr_version" not in columns:
+            # the OCR mode of the texts extracted before is unknown
+            conn.execute(f"DROP TABLE {TABLE_NAME}")
+
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                attachment TEXT,
+                ocr_version TEXT,
+                text TEXT,
+                usage TEXT,
+                extracted_at REAL,
+                PRIMARY KEY (attachment, ocr_version)
+            )
+            """
+        )
+
+
+def split_attachments(attachments: str) -> list[str]:
+    """File names of the comma separated attachments column"""
+    return [
+        attachment.strip()
+        for attachment in (attachments or "").split(",")
+        if attachment.strip()
+    ]
+
+
+def pending_attachments(conn: sqlite3.Connection, ocr_version: str) -> list[str]:
+    """Attachments referenced by the emails that have no text of the OCR version yet"""
+    extracted = {
+        row[0]
+        for row in conn.execute(
+            f"SELECT attachment FROM {TABLE_NAME} WHERE ocr_version = ?",
+            (ocr_version,),
+        )
+    }
+    pending = set()
+    for (attachments,) in conn.execute(
+        f"SELECT DISTINCT attachments FROM {EMAIL_TABLE_NAME} WHERE attachments != ''"
+    ):
+        pending.update(split_attachments(attachments))
+    return sorted(pending - extracted)
+
+
+def save_attachment_texts(
+    conn: sqlite3.Connection,
+    rows: list[tuple[str, str, dict[str, Any]]],
+    ocr_version: str,
+):
+    """Save (attachment, text, usage) rows of the OCR version in one transaction"""
+    now = time.time()
+    with conn:
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO {TABLE_NAME}
+            (attachment, ocr_version, text, usage, extracted_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                (attachment, ocr_version, text, json.dumps(usage), now)
+                for attachment, text, usage in rows
+            ],
+        )
+
+
+def get_attachment_text(email_db_path: str, attachment: str, ocr_version: str) -> str:
+    """Precomputed text of an attachment, None if it was not extracted with the OCR version"""
+    try:
+        row = (
+            get_connection(email_db_path, read_only=True)
+            .execute(
+                f"SELECT text FROM {TABLE_NAME} WHERE attachment = ? AND ocr_version = ?",
+                (attachment, ocr_version),
+            )
+            .fetchone()
+        )
+    except sqlite3.OperationalError:
+        # no database yet, or no pre-extraction ran against it since the
+        # OCR version is stored
+        return None
+    return row[0] if row else None
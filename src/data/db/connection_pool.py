@@ -0,0 +1,136 @@
+"""
+Per-thread SQLite connections shared by the tools, ReconApp and db_scripts,
+so that the databases are not reopened on every query
+"""
+
+import os
+import sqlite3
+import threading
+
+# prepared statements kept by every connection, keyed by their SQL
+CACHED_STATEMENTS = 256
+
+
+def busy_timeout() -> float:
+    """Seconds a connection waits for a locked database, from SQLITE_BUSY_TIMEOUT_MS"""
+    return int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000")) / 1000
+
+
+def enable_wal(db_path: str):
+    """
+    Switch a database to WAL journaling, kept by the database file, so that
+    its readers and its writer don't block each other
+    """
+    conn = sqlite3.connect(db_path, timeout=busy_timeout())
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+
+
+def connect_read_only(db_path: str, **kwargs) -> sqlite3.Connection:
+    """Read-only connection to a database, failing if the file is missing"""
+    return sqlite3.connect(
+        f"file:{db_path}?mode=ro", uri=True, timeout=busy_timeout(), **kwargs
+    )
+
+
+class ConnectionPool:
+    """
+    One connection per thread to a SQLite database
+
+    A connection is opened on the first use of its thread and kept until
+    the pool is closed, along with the prepared statements of its last
+    CACHED_STATEMENTS queries, so a parameterized query is compiled once
+    per thread instead of once per call
+
+    Read-only pools open the database with mode=ro, which with WAL reads
+    the last committed state without waiting for the writer
+    """
+
+    def __init__(self, db_path: str, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections: list[sqlite3.Connection] = []
+        # bumped on close, so the threads reopen their connection
+        self.generation = 0
+
+    def connection(self, create: bool = True) -> sqlite3.Connection:
+        """
+        Connection of the calling thread, None when the database file
+        is missing and create is False
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.generation == self.generation:
+            return conn
+
+        if not create and not os.path.exists(self.db_path):
+            return None
+
+        # closed from any thread by close()
+        if self.read_only:
+            conn = connect_read_only(
+                self.db_path,
+                cached_statements=CACHED_STATEMENTS,
+                check_same_thread=False,
+            )
+        else:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=busy_timeout(),
+                cached_statements=CACHED_STATEMENTS,
+                check_same_thread=False,
+            )
+            # commits in WAL mode only sync on checkpoints
+            conn.execute("PRAGMA synchronous = NORMAL")
+        with self.lock:
+            self.connections.append(conn)
+            self.local.conn = conn
+            self.local.generation = self.generation
+        return conn
+
+    def close(self):
+        """Close the connections of every thread, they are reopened on next use"""
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.generation += 1
+
+
+_pools: dict[tuple[str, bool], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(db_path: str, read_only: bool = False) -> ConnectionPool:
+    """Get the shared connection pool of a database, created on first use"""
+    key = (os.path.abspath(db_path), read_only)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(key[0], read_only=read_only)
+        return _pools[key]
+
+
+def get_connection(db_path: str, read_only: bool = False) -> sqlite3.Connection:
+    """Connection of the calling thread to a database"""
+    return get_connection_pool(db_path, read_only=read_only).connection()
+
+
+def close_connections(db_path: str = None):
+    """Close the pooled connections of a database, or of every database"""
+    with _pools_lock:
+        if db_path is None:
+            pools = list(_pools.values())
+        else:
+            pools = [
+                pool
+                for (path, _), pool in _pools.items()
+                if path == os.path.abspath(db_path)
+            ]
+
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,179 @@
+"""
+Incremental sync of the dataset CSVs into the existing databases, upserting
+the new and changed rows by primary key while keeping the reconciliation
+state, and a watcher syncing the CSVs whenever they are written
+"""
+
+import csv
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from src.data.db.connection_pool import busy_timeout
+from src.data.db.schema import TABLE_SCHEMAS, migrate_table, row_converter
+from src.misc.beautified_logging import BeautifiedLogging
+
+logging = BeautifiedLogging()
+
+# rows per transaction, small enough not to hold up the running workers
+SYNC_CHUNK_ROWS = 10_000
+
+
+def upsert_query(table_name: str, headers: list[str]) -> str:
+    """
+    INSERT of the CSV columns updating the existing rows on their primary key,
+    apart from the state columns, and only when a value changed
+    """
+    schema = TABLE_SCHEMAS[table_name]
+    primary_key = schema["primary_key"]
+    updated = [
+        header
+        for header in headers
+        if header != primary_key and header not in schema.get("state_columns", [])
+    ]
+
+    query = f"""
+        INSERT INTO {table_name} ({", ".join(f'"{header}"' for header in headers)})
+        VALUES ({", ".join(["?" for _ in headers])})
+        ON CONFLICT ("{primary_key}") DO
+        """
+    if not updated:
+        return f"{query} NOTHING"
+
+    set_clause = ", ".join(f'"{column}" = excluded."{column}"' for column in updated)
+    changed = " OR ".join(f'"{column}" IS NOT excluded."{column}"' for column in updated)
+    return f"{query} UPDATE SET {set_clause} WHERE {changed}"
+
+
+def sync_csv(
+    csv_file_path: str,
+    sqlite_db_path: str,
+    table_name: str,
+    chunk_rows: int = SYNC_CHUNK_ROWS,
+) -> dict[str, int]:
+    """
+    Upsert the rows of a CSV into an existing table, returns the number
+    of rows read, inserted and updated, or None when the table has no
+    primary key to upsert on
+    """
+    start_time = time.perf_counter()
+
+    # the upsert needs the primary key of the typed schema
+    if not migrate_table(sqlite_db_path, table_name):
+        logging.info("User", f"Cannot sync {table_name} without its primary key")
+        return None
+
+    conn = sqlite3.connect(sqlite_db_path, timeout=busy_timeout())
+    try:
+        count_query = f"SELECT COUNT(*) FROM {table_name}"
+        rows_before = conn.execute(count_query).fetchone()[0]
+
+        rows = 0
+        changes = 0
+        with open(csv_file_path, "r", newline="", encoding="utf-8") as csv_file:
+            reader = csv.reader(csv_file)
+            headers = next(reader)
+
+            query = upsert_query(table_name, headers)
+            convert = row_converter(table_name, headers)
+            while True:
+                chunk = [convert(row) for row in itertools.islice(reader, chunk_rows)]
+                if not chunk:
+                    break
+                with conn:
+                    changes += conn.executemany(query, chunk).rowcount
+                rows += len(chunk)
+
+        inserted = conn.execute(count_query).fetchone()[0] - rows_before
+    finally:
+        conn.close()
+
+    result = {"rows": rows, "inserted": inserted, "updated": changes - inserted}
+    logging.info(
+        "User",
+        f"""
+        Synced {csv_file_path} into {table_name}
+
+        Rows: {rows}, inserted: {result["inserted"]}, updated: {result["updated"]}
+        in {time.perf_counter() - start_time:.1f} s
+        """,
+    )
+    return result
+
+
+class DatasetWatcher(FileSystemEventHandler):
+    """
+    Syncs the dataset CSVs into their tables whenever they are written,
+    once no write happened for debounce_seconds
+
+    Tables are given as the csv_file_path, sqlite_db_path and table_name
+    arguments of sync_csv
+    """
+
+    def __init__(self, tables: list[dict[str, str]], debounce_seconds: float = 1):
+        self.tables = {os.path.abspath(table["csv_file_path"]): table for table in tables}
+        self.debounce_seconds = debounce_seconds
+
+        self.lock = threading.Lock()
+        # one sync at a time, a write during a sync schedules the next one
+        self.sync_lock = threading.Lock()
+        self.timers: dict[str, threading.Timer] = {}
+        self.observer = None
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in (
+            "created",
+            "modified",
+            "moved",
+            "closed",
+        ):
+            return
+
+        for path in [event.src_path, getattr(event, "dest_path", "")]:
+            path = os.path.abspath(os.fsdecode(path)) if path else ""
+            if path in self.tables:
+                self.__schedule(path)
+
+    def __schedule(self, path: str):
+        with self.lock:
+            if path in self.timers:
+                self.timers[path].cancel()
+            timer = threading.Timer(self.debounce_seconds, self.__sync, args=(path,))
+            timer.daemon = True
+            self.timers[path] = timer
+            timer.start()
+
+    def __sync(self, path: str):
+        with self.lock:
+            self.timers.pop(path, None)
+
+        with self.sync_lock:
+            try:
+                sync_csv(**self.tables[path])
+            except (OSError, csv.Error, sqlite3.Error) as e:
+                # i.e. a row still being written, synced again on the next write
+                logging.info("User", f"Sync of {path} failed: {e}")
+
+    def start(self):
+        """Start watching the directories of the CSVs"""
+        self.observer = Observer()
+        for directory in {os.path.dirname(path) for path in self.tables}:
+            self.observer.schedule(self, directory)
+        self.observer.start()
+
+    def stop(self):
+        """Stop watching, the pending syncs are dropped"""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers = {}
@@ -1,101 +1,164 @@
 import csv
+import itertools
 import os
 from pathlib import Path
 import sqlite3
 import sys
+import time
 
 from dotenv import load_dotenv
 
+from src.data.db.connection_pool import (
+    close_connections,
+    enable_wal,
+    get_connection_pool,
+)
+from src.data.db.csv_sync import sync_csv
+from src.data.db.schema import (
+    create_indexes,
+    create_table_query,
+    migrate_table,
+    row_converter,
+)
 from src.misc.path_parser import get_db_path
+from src.misc.tracing import span
 
 cwd = os.getcwd()
 sys.path.insert(0, "f{cwd}/src")
 
 load_dotenv()
 
+# rows read from the CSV and inserted per executemany and transaction
+IMPORT_CHUNK_ROWS = 100_000
 
-def csv_to_sqlite(csv_file_path, sqlite_db_path, table_name):
+# page cache of the import in KiB, bounds its memory use
+IMPORT_CACHE_KB = 64 * 1024
+
+
+def remove_db_files(sqlite_db_path):
+    """Delete a SQLite database file along with its journal, WAL and shared memory files"""
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        if os.path.exists(f"{sqlite_db_path}{suffix}"):
+            os.remove(f"{sqlite_db_path}{suffix}")
+
+
+def csv_to_sqlite(
+    csv_file_path, sqlite_db_path, table_name, chunk_rows=IMPORT_CHUNK_ROWS
+):
     """
     Converts a CSV file into a SQLite database table.
 
+    The CSV is streamed in chunks of chunk_rows rows, each inserted with one
+    executemany in its own transaction, and the indexes are built after the load.
+    The import is written to a file next to the database which replaces it once
+    complete, a failed import deletes that file and leaves the database as it was.
+
     :param csv_file_path: Path to the input CSV file.
     :param sqlite_db_path: Path to the output SQLite database file.
     :param table_name: Name of the table to create in the database.
+    :param chunk_rows: Rows inserted per transaction.
     """
+    start_time = time.perf_counter()
 
-    # Delete the SQLite database file if it exists
-    if os.path.exists(sqlite_db_path):
-        os.remove(sqlite_db_path)
-
-    # Connect to SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect(sqlite_db_path)
-    cursor = conn.cursor()
-
-    # Open the CSV file
-    with open(csv_file_path, "r", newline="", encoding="utf-8") as csv_file:
-        reader = csv.reader(csv_file)
-
-        # Extract the header (first row)
-        headers = next(reader)
-
-        # Create table with columns based on the header
-        columns = ", ".join([f'"{header}" TEXT' for header in headers])
-        create_table_query = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns});"
-        cursor.execute(create_table_query)
-
-        # Insert data into the table
-        insert_query = f'INSERT INTO {table_name} ({", ".join(headers)}) VALUES ({", ".join(["?" for _ in headers])});'
-        for row in reader:
-            cursor.execute(insert_query, row)
+    import_db_path = f"{sqlite_db_path}.import"
+    remove_db_files(import_db_path)
+    conn = sqlite3.connect(import_db_path)
 
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
+    # the file is deleted if the import fails,
+    # so it is written without rollback journal nor fsync
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_KB}")
 
+    rows = 0
+    try:
+        try:
+            # Open the CSV file
+            with open(csv_file_path, "r", newline="", encoding="utf-8") as csv_file:
+                reader = csv.reader(csv_file)
+
+                # Extract the header (first row)
+                headers = next(reader)
+
+                # Create table with the declared types of the columns in the header
+                conn.execute(create_table_query(table_name, headers))
+
+                # Insert data into the table
+                insert_query = f'INSERT INTO {table_name} ({", ".join(headers)}) VALUES ({", ".join(["?" for _ in headers])});'
+                convert = row_converter(table_name, headers)
+                while True:
+                    chunk = [convert(row) for row in itertools.islice(reader, chunk_rows)]
+                    if not chunk:
+                        break
+                    with conn:
+                        conn.executemany(insert_query, chunk)
+                    rows += len(chunk)
+
+            # indexes are built once over the loaded rows
+            with conn:
+                create_indexes(conn, table_name)
+
+            # the readers of the database don't wait for its writer
+            conn.execute("PRAGMA journal_mode = WAL")
+        finally:
+            conn.close()
+    except BaseException:
+        remove_db_files(import_db_path)
+        raise
+
+    # the WAL of the replaced database must not be applied to the new one
+    close_connections(sqlite_db_path)
+    for suffix in ["-journal", "-wal", "-shm"]:
+        if os.path.exists(f"{sqlite_db_path}{suffix}"):
+            os.remove(f"{sqlite_db_path}{suffix}")
+    os.replace(import_db_path, sqlite_db_path)
+
+    elapsed = time.perf_counter() - start_time
     print(
-        f"CSV data has been successfully imported into the table '{table_name}' in '{sqlite_db_path}'."
+        f"CSV data has been successfully imported into the table '{table_name}' in '{sqlite_db_path}'. "
+        f"{rows} rows in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):,.0f} rows/s)"
     )
 
 
-def query_sqlite_db(sqlite_db_path, query, throw=False):
+def query_sqlite_db(sqlite_db_path, query, throw=False, parameters=(), read_only=False):
     """
     Queries a SQLite database and prints the results.
 
     :param sqlite_db_path: Path to the SQLite database file.
     :param query: SQL query to execute.
+    :param parameters: Values of the ? placeholders of the query.
+    :param read_only: Query on a read-only connection, for SELECT queries.
     """
-    if not os.path.exists(sqlite_db_path):
+    # the pooled connection of the thread, the file is only checked when opening it
+    conn = get_connection_pool(sqlite_db_path, read_only=read_only).connection(
+        create=False
+    )
+    if conn is None:
         print(f"Database file '{sqlite_db_path}' does not exist.")
         return
 
-    # Connect to SQLite database
-    conn = sqlite3.connect(sqlite_db_path)
-    cursor = conn.cursor()
-
-    data = []
-    try:
-        # Execute the query
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        data.extend(rows)
-    except sqlite3.Error as e:
-        if throw:
-            raise sqlite3.Error(e)
-        print(f"An error has occured: {e}")
-    finally:
-        # Close the connection
-        conn.close()
+    with span("query_sqlite_db", "db", db=os.path.basename(sqlite_db_path), query=query):
+        data = []
+        try:
+            # Execute the query
+            cursor = conn.execute(query, parameters)
+            rows = cursor.fetchall()
+            data.extend(rows)
+        except sqlite3.Error as e:
+            if throw:
+                raise sqlite3.Error(e)
+            print(f"An error has occured: {e}")
     return data
 
 
-def set_db(reset=False):
+def dataset_tables():
     """
-    Reset db to the initial state
+    CSV files of the dataset and the database tables they are imported into
     """
     synthetic_data_path = f"{cwd}/dataset"
     sqlite_path = get_db_path()
 
-    sql_builder = [
+    return [
         {
             "csv_file_path": f"{synthetic_data_path}/emails.csv",
             "sqlite_db_path": f"{sqlite_path}/emails.db",
@@ -108,14 +171,29 @@ def set_db(reset=False):
         },
     ]
 
+
+def set_db(reset=False, sync=False):
+    """
+    Reset db to the initial state, or with sync upsert the new and
+    changed rows of the CSVs into the existing db, keeping its state
+    """
+    sqlite_path = get_db_path()
+
     if not os.path.exists(sqlite_path):
         os.makedirs(sqlite_path)
 
-    for x in sql_builder:
+    for x in dataset_tables():
         db_exists = Path(x["sqlite_db_path"]).is_file()
         csv_exists = Path(x["csv_file_path"]).is_file()
 
-        if ((not reset) & db_exists) | (not csv_exists):
-            continue
-
-        csv_to_sqlite(**x)
+        if (not reset) & db_exists & csv_exists & sync:
+            sync_csv(**x)
+        # databases imported before the typed schema are migrated in place
+        elif (not reset) & db_exists:
+            migrate_table(x["sqlite_db_path"], x["table_name"])
+        elif csv_exists:
+            csv_to_sqlite(**x)
+
+        # databases created before WAL are switched to it
+        if Path(x["sqlite_db_path"]).is_file():
+            enable_wal(x["sqlite_db_path"])
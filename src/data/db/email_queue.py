@@ -0,0 +1,271 @@
+"""
+Lease based work queue on the emails table so that
+several app.py processes can share the same emails.db
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any
+
+from src.data.db.connection_pool import busy_timeout
+from src.data.db.status_writer import group_email_rows
+from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.tracing import span
+
+logging = BeautifiedLogging()
+
+TABLE_NAME = "emails"
+
+LEASE_COLUMNS = {"worker_id": "TEXT", "lease_expires_at": "REAL", "claimed_at": "REAL"}
+
+
+def new_worker_id() -> str:
+    """Worker id unique across hosts and processes"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class EmailWorkQueue:
+    """
+    Workers claim emails by atomically moving them from NOT_STARTED
+    to IN_PROGRESS with their worker id and a lease expiry.
+
+    Leases of the claimed emails are renewed in the background while the
+    worker is alive, so a lease only expires when its worker died, after
+    which the email can be claimed again by another worker
+
+    claim_statuses other than NOT_STARTED, i.e. the failures retried by
+    --resume, are only claimed when the email was last claimed before the
+    worker started, so an email failing again in this run is not retried
+    over and over
+    """
+
+    def __init__(
+        self,
+        email_db_path: str,
+        worker_id: str = None,
+        lease_seconds: float = 600,
+        claim_statuses: list[str] = None,
+    ):
+        self.worker_id = worker_id or new_worker_id()
+        self.lease_seconds = lease_seconds
+        self.claim_statuses = claim_statuses or ["NOT_STARTED"]
+        self.started_at = time.time()
+
+        # transactions are managed explicitly to claim with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(
+            email_db_path,
+            timeout=busy_timeout(),
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.lock = threading.Lock()
+
+        self.held_email_ids: set[str] = set()
+        self.__heartbeat = None
+        self.__stop_heartbeat = threading.Event()
+
+        self.__add_lease_columns()
+
+    def __add_lease_columns(self):
+        with self.lock:
+            columns = [
+                row[1] for row in self.conn.execute(f"PRAGMA table_info({TABLE_NAME})")
+            ]
+            for column, column_type in LEASE_COLUMNS.items():
+                if column in columns:
+                    continue
+                try:
+                    self.conn.execute(
+                        f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {column_type}"
+                    )
+                except sqlite3.OperationalError as e:
+                    # another worker added the column in the meantime
+                    if "duplicate column" not in str(e):
+                        raise
+
+    @contextmanager
+    def __transaction(self, name: str):
+        """Write transaction taking the database lock up front, call with the lock held"""
+        with span(name, "db", db=TABLE_NAME):
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self.conn.execute("COMMIT")
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def claim(self, batch_size: int) -> list[tuple]:
+        """
+        Claim up to batch_size emails, including the ones with an expired lease
+
+        Returns the full email rows in the column order of the table
+        """
+        now = time.time()
+        retry_statuses = [
+            status for status in self.claim_statuses if status != "NOT_STARTED"
+        ]
+        retry_params = ", ".join(["?" for _ in retry_statuses])
+
+        with self.lock:
+            with self.__transaction("queue_claim"):
+                email_ids = [
+                    row[0]
+                    for row in self.conn.execute(
+                        f"""
+                        SELECT email_id FROM {TABLE_NAME}
+                        WHERE (process_status = 'NOT_STARTED' AND ? = 1)
+                        OR (
+                            process_status IN ({retry_params})
+                            AND (claimed_at IS NULL OR claimed_at < ?)
+                        )
+                        OR (process_status = 'IN_PROGRESS' AND lease_expires_at < ?)
+                        LIMIT ?
+                        """,
+                        [
+                            "NOT_STARTED" in self.claim_statuses,
+                            *retry_statuses,
+                            self.started_at,
+                            now,
+                            batch_size,
+                        ],
+                    )
+                ]
+                self.conn.executemany(
+                    f"""
+                    UPDATE {TABLE_NAME}
+                    SET process_status = 'IN_PROGRESS', worker_id = ?, lease_expires_at = ?,
+                    claimed_at = ?
+                    WHERE email_id = ?
+                    """,
+                    [
+                        (self.worker_id, now + self.lease_seconds, now, email_id)
+                        for email_id in email_ids
+                    ],
+                )
+
+            if not email_ids:
+                return []
+
+            self.held_email_ids.update(email_ids)
+            id_params = ", ".join(["?" for _ in email_ids])
+            return self.conn.execute(
+                f"SELECT * FROM {TABLE_NAME} WHERE email_id IN ({id_params})",
+                email_ids,
+            ).fetchall()
+
+    def claim_in_batches(self, batch_size: int):
+        """Keep claiming batches of emails until none are left"""
+        while True:
+            batch = self.claim(batch_size)
+            if not batch:
+                break
+            yield batch
+
+    def renew(self):
+        """Extend the leases of all emails held by this worker"""
+        with self.lock:
+            if not self.held_email_ids:
+                return
+
+            lease_expires_at = time.time() + self.lease_seconds
+            with self.__transaction("queue_renew"):
+                self.conn.executemany(
+                    f"""
+                    UPDATE {TABLE_NAME} SET lease_expires_at = ?
+                    WHERE email_id = ? AND worker_id = ?
+                    """,
+                    [
+                        (lease_expires_at, email_id, self.worker_id)
+                        for email_id in self.held_email_ids
+                    ],
+                )
+
+    def complete_many(self, rows: list[tuple[str, dict[str, Any]]]) -> list[str]:
+        """
+        Save the results of several emails in one transaction and release their leases
+
+        Rows are (email_id, data_to_save) tuples, returns the ids of
+        the emails whose lease was lost, for which nothing is saved
+        """
+        email_ids = [email_id for email_id, _ in rows]
+        id_params = ", ".join(["?" for _ in email_ids])
+
+        with self.lock:
+            with self.__transaction("queue_complete_many"):
+                leased_ids = {
+                    row[0]
+                    for row in self.conn.execute(
+                        f"""
+                        SELECT email_id FROM {TABLE_NAME}
+                        WHERE email_id IN ({id_params}) AND worker_id = ?
+                        """,
+                        [*email_ids, self.worker_id],
+                    )
+                }
+                for set_clause, parameters in group_email_rows(
+                    [row for row in rows if row[0] in leased_ids]
+                ).items():
+                    self.conn.executemany(
+                        f"""
+                        UPDATE {TABLE_NAME}
+                        SET {set_clause}, worker_id = NULL, lease_expires_at = NULL
+                        WHERE email_id = ?
+                        """,
+                        parameters,
+                    )
+            self.held_email_ids.difference_update(email_ids)
+
+        lost_ids = [email_id for email_id in email_ids if email_id not in leased_ids]
+        if lost_ids:
+            logging.error(
+                "Queue", f"Leases of emails {lost_ids} were lost, results dropped"
+            )
+        return lost_ids
+
+    def release(self):
+        """Hand the unfinished emails of this worker back to the queue"""
+        with self.lock:
+            if not self.held_email_ids:
+                return
+
+            with self.__transaction("queue_release"):
+                self.conn.executemany(
+                    f"""
+                    UPDATE {TABLE_NAME}
+                    SET process_status = 'NOT_STARTED', worker_id = NULL,
+                    lease_expires_at = NULL
+                    WHERE email_id = ? AND worker_id = ?
+                    """,
+                    [(email_id, self.worker_id) for email_id in self.held_email_ids],
+                )
+            self.held_email_ids.clear()
+
+    def __run_heartbeat(self):
+        # renew well before the lease runs out
+        while not self.__stop_heartbeat.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logging.error("Queue", f"Lease renewal failed: {e}")
+
+    def start(self):
+        """Start renewing the leases in the background"""
+        self.__stop_heartbeat.clear()
+        self.__heartbeat = threading.Thread(
+            target=self.__run_heartbeat, name="lease-heartbeat", daemon=True
+        )
+        self.__heartbeat.start()
+
+    def stop(self):
+        """Stop renewing leases, release the unfinished emails and close the queue"""
+        self.__stop_heartbeat.set()
+        if self.__heartbeat is not None:
+            self.__heartbeat.join()
+        self.release()
+        self.conn.close()
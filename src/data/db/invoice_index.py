@@ -0,0 +1,298 @@
+"""
+In-process index of the transactions by invoice id, so that the invoice
+lookups of the tools, the fast path and the duplicate check skip SQLite
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from functools import lru_cache
+
+from src.data.db.connection_pool import busy_timeout, connect_read_only
+
+TABLE_NAME = "transactions"
+
+INDEX_COLUMNS = [
+    "invoice_id",
+    "bank_name",
+    "transaction_id",
+    "amount",
+    "recipient_name",
+    "sender_name",
+    "reconciliation_state",
+]
+
+STATE_COLUMN = INDEX_COLUMNS.index("reconciliation_state")
+
+# columns of mostly distinct values, the values of the others are shared
+UNIQUE_COLUMNS = ["invoice_id", "transaction_id"]
+
+
+@lru_cache(maxsize=None)
+def _column_indexes(columns: tuple[str, ...]) -> list[int]:
+    return [INDEX_COLUMNS.index(column) for column in columns]
+
+
+class InvoiceIndex:
+    """
+    Rows of the transactions table keyed by invoice id, loaded once
+
+    The rows are stored by column, one list per column of INDEX_COLUMNS,
+    and the invoice ids map to the position of their row, or the list of
+    positions of their rows for the ids repeated in the ledger
+
+    The invoice updates go through the index, which writes them to the
+    database and to the loaded rows. Writes by other connections, i.e.
+    another process or a sync of the CSV, change the data_version of the
+    database and a new file changes its inode, either reloads the index.
+    The table is reloaded on a connection and a thread of its own, the
+    lookups keep reading the rows loaded before until the new ones are
+    swapped in. Changes are checked at most every check_interval seconds,
+    the lookups in between only read the loaded rows
+    """
+
+    def __init__(self, db_path: str, check_interval: float = 0.1):
+        self.db_path = db_path
+        self.check_interval = check_interval
+        self.checked_at = 0.0
+
+        self.lock = threading.Lock()
+        # one load at a time, without holding the lock
+        self.load_lock = threading.Lock()
+        self.conn = None
+        self.inode = None
+
+        # database state the loaded rows are up to date with
+        self.loaded_inode = None
+        self.data_version = None
+        # invoice ids updated while a load reads the table
+        self.loading_updates = None
+
+        self.positions: dict[str, int | list[int]] = {}
+        self.columns: list[list] = [[] for _ in INDEX_COLUMNS]
+
+        self.lookups = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.memory = 0
+
+    def __connect(self):
+        """Open the connection, again when the file was replaced, call with the lock held"""
+        inode = os.stat(self.db_path).st_ino
+        if self.conn is not None and inode == self.inode:
+            return
+
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = sqlite3.connect(
+            self.db_path, timeout=busy_timeout(), check_same_thread=False
+        )
+        self.inode = inode
+
+    def __changed(self) -> bool:
+        """Whether the database changed outside of the index, call with the lock held"""
+        self.__connect()
+        return (
+            self.inode != self.loaded_inode
+            or self.conn.execute("PRAGMA data_version").fetchone()[0]
+            != self.data_version
+        )
+
+    def __load_table(self) -> tuple:
+        """Read the whole table, on a connection of its own"""
+        # the repeated names and states of the ledger share one string
+        strings = {}
+        shared = [column not in UNIQUE_COLUMNS for column in INDEX_COLUMNS]
+
+        positions = {}
+        columns = [[] for _ in INDEX_COLUMNS]
+        conn = connect_read_only(self.db_path)
+        try:
+            for position, row in enumerate(
+                conn.execute(f"SELECT {', '.join(INDEX_COLUMNS)} FROM {TABLE_NAME}")
+            ):
+                for index, value in enumerate(row):
+                    if shared[index] and isinstance(value, str):
+                        value = strings.setdefault(value, value)
+                    columns[index].append(value)
+
+                invoice_id = row[0]
+                if invoice_id not in positions:
+                    positions[invoice_id] = position
+                elif isinstance(positions[invoice_id], list):
+                    positions[invoice_id].append(position)
+                else:
+                    positions[invoice_id] = [positions[invoice_id], position]
+        finally:
+            conn.close()
+
+        return positions, columns, self.__memory_bytes(positions, columns, strings)
+
+    def __load(self):
+        """Load the table, the lookups read the previous rows meanwhile"""
+        # only the first load is waited for, by the threads looking up
+        if not self.load_lock.acquire(blocking=not self.loads):
+            return
+
+        try:
+            with self.lock:
+                # loaded by another thread in the meantime
+                if not self.__changed():
+                    return
+                # read before the table, so no commit in between is missed
+                inode = self.inode
+                data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+                self.loading_updates = []
+
+            start_time = time.perf_counter()
+            try:
+                positions, columns, memory = self.__load_table()
+            finally:
+                with self.lock:
+                    loading_updates, self.loading_updates = self.loading_updates, None
+
+            with self.lock:
+                # the own updates committed while the table was read
+                for invoice_id in loading_updates:
+                    for position in self.__positions(invoice_id, positions):
+                        columns[STATE_COLUMN][position] = "PAID"
+
+                self.positions = positions
+                self.columns = columns
+                self.memory = memory
+                self.loaded_inode = inode
+                self.data_version = data_version
+                self.loads += 1
+                self.load_seconds += time.perf_counter() - start_time
+        finally:
+            self.load_lock.release()
+
+    def __refresh(self):
+        """Reload when the database changed outside of the index"""
+        # read without the lock, a lookup racing a check skips it
+        if self.loads and time.monotonic() - self.checked_at < self.check_interval:
+            return
+
+        with self.lock:
+            if (
+                self.loads
+                and time.monotonic() - self.checked_at < self.check_interval
+            ):
+                return
+
+            self.checked_at = time.monotonic()
+            if not self.__changed():
+                return
+
+        if not self.loads:
+            self.__load()
+        elif not self.load_lock.locked():
+            # the lookups go on with the loaded rows until the new ones are in
+            threading.Thread(
+                target=self.__load, name="invoice-index-load", daemon=True
+            ).start()
+
+    def __memory_bytes(
+        self,
+        positions: dict[str, int | list[int]],
+        columns: list[list],
+        strings: dict[str, str],
+    ) -> int:
+        """Approximate memory used by the loaded rows"""
+        size = sys.getsizeof(positions)
+        size += sum(map(sys.getsizeof, positions))
+        size += sum(map(sys.getsizeof, positions.values()))
+        for column, values in zip(INDEX_COLUMNS, columns):
+            size += sys.getsizeof(values)
+            if column == "invoice_id":
+                # the same strings as the keys of the positions
+                continue
+            if column in UNIQUE_COLUMNS or not values or not isinstance(values[0], str):
+                size += sum(map(sys.getsizeof, values))
+        return size + sum(map(sys.getsizeof, strings))
+
+    def __positions(
+        self, invoice_id: str, positions: dict[str, int | list[int]] = None
+    ) -> list[int]:
+        """Positions of the rows of an invoice id, in the loaded rows by default"""
+        positions = (self.positions if positions is None else positions).get(
+            str(invoice_id)
+        )
+        if positions is None:
+            return []
+        return positions if isinstance(positions, list) else [positions]
+
+    def lookup(self, invoice_id: str, columns: list[str] = None) -> list[tuple]:
+        """Rows of an invoice id, with the given columns or all of INDEX_COLUMNS"""
+        indexes = _column_indexes(tuple(columns or INDEX_COLUMNS))
+        self.__refresh()
+        with self.lock:
+            self.lookups += 1
+            return [
+                tuple([self.columns[index][position] for index in indexes])
+                for position in self.__positions(invoice_id)
+            ]
+
+    def update(self, invoice_id: str, email_details: str) -> int:
+        """Mark the rows of an invoice id as PAID, returns the number of rows updated"""
+        self.__refresh()
+        with self.lock:
+            with self.conn:
+                updated = self.conn.execute(
+                    f"""
+                    UPDATE {TABLE_NAME}
+                    SET reconciliation_state = 'PAID', email_details = ?
+                    WHERE invoice_id = ?
+                    """,
+                    (email_details, invoice_id),
+                ).rowcount
+
+            # the own commits don't change the data_version of the connection,
+            # and may be missing from the table a load is reading
+            if self.loading_updates is not None:
+                self.loading_updates.append(invoice_id)
+            for position in self.__positions(invoice_id):
+                self.columns[STATE_COLUMN][position] = "PAID"
+            return updated
+
+    def report(self) -> str:
+        """Index report for the logs"""
+        with self.lock:
+            return f"""
+            Invoice index: {len(self.columns[0])} rows, {len(self.positions)} invoice ids, {self.memory / 1024**2:.1f} MiB
+            Lookups: {self.lookups}, loads: {self.loads} in {self.load_seconds:.2f} s
+            """
+
+
+_invoice_indexes: dict[str, InvoiceIndex] = {}
+_invoice_indexes_lock = threading.Lock()
+
+
+def get_invoice_index(db_path: str) -> InvoiceIndex:
+    """
+    Get the shared invoice index of a transactions database
+
+    The index is enabled with INVOICE_INDEX=true and loaded on first use,
+    returns None when disabled. The changes made outside of the index are
+    checked for every INVOICE_INDEX_CHECK_MS (default 100)
+    """
+    if os.getenv("INVOICE_INDEX") != "true":
+        return None
+
+    db_path = os.path.abspath(db_path)
+    with _invoice_indexes_lock:
+        if db_path not in _invoice_indexes:
+            _invoice_indexes[db_path] = InvoiceIndex(
+                db_path,
+                check_interval=float(os.getenv("INVOICE_INDEX_CHECK_MS", "100")) / 1000,
+            )
+        return _invoice_indexes[db_path]
+
+
+def invoice_index_reports() -> list[str]:
+    """Reports of the loaded invoice indexes"""
+    with _invoice_indexes_lock:
+        indexes = list(_invoice_indexes.values())
+    return [index.report() for index in indexes if index.loads]
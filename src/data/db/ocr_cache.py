@@ -0,0 +1,167 @@
+"""
+Disk backed cache of the OCR transcriptions, so that retries, reruns and
+model comparisons over the same attachments skip the vision model
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+cwd = os.getcwd()
+
+TABLE_NAME = "ocr_cache"
+
+
+def content_hash(data: bytes) -> str:
+    """sha256 of the attachment content"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class OcrCache:
+    """
+    Transcriptions keyed by the content hash of the attachment, the vision
+    model and the prompt version, evicting the least recently used entries
+    once the stored text exceeds max_bytes
+    """
+
+    def __init__(self, db_path: str, max_bytes: int = 256 * 1024**2):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                    content_hash TEXT,
+                    vision_model TEXT,
+                    prompt_version TEXT,
+                    text TEXT,
+                    size_bytes INTEGER,
+                    created_at REAL,
+                    last_used_at REAL,
+                    PRIMARY KEY (content_hash, vision_model, prompt_version)
+                )
+                """
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {TABLE_NAME}_last_used_at ON {TABLE_NAME} (last_used_at)"
+            )
+
+    def get(self, key: tuple[str, str, str]) -> str:
+        """Cached transcription of the (content_hash, vision_model, prompt_version) key, or None"""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                f"""
+                SELECT text FROM {TABLE_NAME}
+                WHERE content_hash = ? AND vision_model = ? AND prompt_version = ?
+                """,
+                key,
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.conn.execute(
+                f"""
+                UPDATE {TABLE_NAME} SET last_used_at = ?
+                WHERE content_hash = ? AND vision_model = ? AND prompt_version = ?
+                """,
+                (time.time(), *key),
+            )
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: tuple[str, str, str], text: str):
+        """Store a transcription and evict the oldest entries over the size limit"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"""
+                INSERT OR REPLACE INTO {TABLE_NAME}
+                (content_hash, vision_model, prompt_version, text, size_bytes, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (*key, text, len(text.encode("utf-8")), now, now),
+            )
+            self.stores += 1
+            self.__evict()
+
+    def __evict(self):
+        total_bytes = self.conn.execute(
+            f"SELECT COALESCE(SUM(size_bytes), 0) FROM {TABLE_NAME}"
+        ).fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        rows = self.conn.execute(
+            f"""
+            SELECT rowid, size_bytes FROM {TABLE_NAME}
+            ORDER BY last_used_at
+            """
+        )
+        evicted = []
+        for rowid, size_bytes in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            evicted.append((rowid,))
+            total_bytes -= size_bytes
+
+        self.conn.executemany(f"DELETE FROM {TABLE_NAME} WHERE rowid = ?", evicted)
+        self.evictions += len(evicted)
+
+    def metrics(self) -> dict[str, float]:
+        """Hit and miss counters of the process"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+    def report(self) -> str:
+        """Metrics report for the logs"""
+        metrics = self.metrics()
+        return f"""
+            OCR cache hits: {metrics["hits"]}/{metrics["hits"] + metrics["misses"]} ({metrics["hit_rate"]:.2%})
+            Stored: {metrics["stores"]}, evicted: {metrics["evictions"]}
+            """
+
+
+_ocr_cache: OcrCache = None
+_ocr_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> OcrCache:
+    """
+    Get the shared OCR cache of the process
+
+    The cache is stored in OCR_CACHE_PATH (default src/data/db/ocr_cache.db),
+    shared by the runs of every model pair, and holds up to OCR_CACHE_MAX_MB
+    of text (default 256). A size of 0 disables the cache and returns None
+    """
+    global _ocr_cache
+
+    max_mb = float(os.getenv("OCR_CACHE_MAX_MB", "256") or 0)
+    if max_mb <= 0:
+        return None
+
+    with _ocr_cache_lock:
+        if _ocr_cache is None:
+            db_path = os.getenv("OCR_CACHE_PATH", f"{cwd}/src/data/db/ocr_cache.db")
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            _ocr_cache = OcrCache(db_path, max_bytes=int(max_mb * 1024**2))
+        return _ocr_cache
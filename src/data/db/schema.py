@@ -0,0 +1,206 @@
+"""
+Declared column types, primary keys and indexes of the tables imported
+from the dataset CSVs, and the migration of the databases created with
+every column as TEXT
+"""
+
+import sqlite3
+from typing import Callable
+
+from src.misc.beautified_logging import BeautifiedLogging
+
+logging = BeautifiedLogging()
+
+TABLE_SCHEMAS = {
+    "transactions": {
+        "columns": {
+            "invoice_id": "TEXT",
+            "bank_name": "TEXT",
+            "transaction_id": "TEXT",
+            "amount": "REAL",
+            "recipient_name": "TEXT",
+            "sender_name": "TEXT",
+            "reconciliation_state": "TEXT",
+            "email_details": "TEXT",
+        },
+        # invoice ids are not unique in the ledger
+        "primary_key": "transaction_id",
+        "indexes": ["invoice_id"],
+        # written by the reconciliation, kept when the CSV is synced again
+        "state_columns": ["reconciliation_state", "email_details"],
+    },
+    "emails": {
+        "columns": {
+            "email_id": "TEXT",
+            "sender_email": "TEXT",
+            "recipient_email": "TEXT",
+            "subject": "TEXT",
+            "email_body": "TEXT",
+            "attachments": "TEXT",
+            "process_status": "TEXT",
+            "response": "TEXT",
+            "start_time": "TEXT",
+            "end_time": "TEXT",
+            "full_logs": "TEXT",
+            "total_time": "REAL",
+            "successful_requests": "INTEGER",
+            "total_tokens": "INTEGER",
+            "prompt_tokens": "INTEGER",
+            "completion_tokens": "INTEGER",
+            "total_cost": "REAL",
+        },
+        "primary_key": "email_id",
+        "indexes": ["process_status"],
+        "state_columns": [
+            "process_status",
+            "response",
+            "start_time",
+            "end_time",
+            "full_logs",
+            "total_time",
+            "successful_requests",
+            "total_tokens",
+            "prompt_tokens",
+            "completion_tokens",
+            "total_cost",
+        ],
+    },
+}
+
+
+def column_type(table_name: str, column: str) -> str:
+    """Declared type of a column, TEXT for the columns without a schema"""
+    return TABLE_SCHEMAS.get(table_name, {}).get("columns", {}).get(column, "TEXT")
+
+
+def create_table_query(
+    table_name: str,
+    columns: list[str],
+    column_types: dict[str, str] = None,
+    create_as: str = None,
+) -> str:
+    """
+    CREATE TABLE query of the columns, with their declared type and primary key,
+    column_types overrides the types and create_as the name of the created table
+    """
+    column_types = column_types or {}
+    primary_key = TABLE_SCHEMAS.get(table_name, {}).get("primary_key")
+
+    definitions = []
+    for column in columns:
+        definition = f'"{column}" {column_types.get(column) or column_type(table_name, column)}'
+        if column == primary_key:
+            definition += " PRIMARY KEY"
+        definitions.append(definition)
+    return f"CREATE TABLE IF NOT EXISTS {create_as or table_name} ({', '.join(definitions)});"
+
+
+def row_converter(table_name: str, columns: list[str]) -> Callable[[list[str]], list]:
+    """Converter of the CSV rows, turning the empty values of the numeric columns to NULL"""
+    numeric = [
+        index
+        for index, column in enumerate(columns)
+        if column_type(table_name, column) != "TEXT"
+    ]
+    if not numeric:
+        return lambda row: row
+
+    def convert(row: list[str]) -> list[str]:
+        for index in numeric:
+            if row[index] == "":
+                row[index] = None
+        return row
+
+    return convert
+
+
+def create_indexes(conn: sqlite3.Connection, table_name: str):
+    """Create the missing indexes of the table"""
+    for column in TABLE_SCHEMAS.get(table_name, {}).get("indexes", []):
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS {table_name}_{column} ON {table_name} ("{column}")'
+        )
+
+
+def is_migrated(conn: sqlite3.Connection, table_name: str) -> bool:
+    """Whether the columns of the table have their declared type and primary key"""
+    schema = TABLE_SCHEMAS[table_name]
+    table_info = {
+        row[1]: (row[2].upper(), row[5])
+        for row in conn.execute(f"PRAGMA table_info({table_name})")
+    }
+    return all(
+        column not in table_info
+        or table_info[column]
+        == (declared_type, 1 if column == schema["primary_key"] else 0)
+        for column, declared_type in schema["columns"].items()
+    )
+
+
+def migrate_table(db_path: str, table_name: str) -> bool:
+    """
+    Rebuild a table created with every column as TEXT with its declared
+    types and primary key, keeping its rows and the columns added since,
+    then create its indexes
+
+    Returns False when the table could not be migrated, i.e. on duplicate
+    primary keys, in which case it is left as it was
+    """
+    if table_name not in TABLE_SCHEMAS:
+        return True
+
+    # autocommit, so the rebuild runs in one explicit transaction
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+        if not columns:
+            return True
+
+        if is_migrated(conn, table_name):
+            create_indexes(conn, table_name)
+            return True
+
+        # the columns added since the import keep their type
+        column_types = {
+            row[1]: row[2] or "TEXT"
+            for row in conn.execute(f"PRAGMA table_info({table_name})")
+            if row[1] not in TABLE_SCHEMAS[table_name]["columns"]
+        }
+        quoted = ", ".join(f'"{column}"' for column in columns)
+        values = ", ".join(
+            (
+                f'NULLIF("{column}", \'\')'
+                if column_type(table_name, column) != "TEXT"
+                else f'"{column}"'
+            )
+            for column in columns
+        )
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                create_table_query(
+                    table_name,
+                    columns,
+                    column_types,
+                    create_as=f"{table_name}_migration",
+                )
+            )
+            conn.execute(
+                f"INSERT INTO {table_name}_migration ({quoted}) SELECT {values} FROM {table_name}"
+            )
+            conn.execute(f"DROP TABLE {table_name}")
+            conn.execute(f"ALTER TABLE {table_name}_migration RENAME TO {table_name}")
+            create_indexes(conn, table_name)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            conn.execute("ROLLBACK")
+            logging.info("User", f"Could not migrate {table_name} in {db_path}: {e}")
+            # the indexes don't depend on the types
+            create_indexes(conn, table_name)
+            return False
+    finally:
+        conn.close()
+
+    logging.info("User", f"Migrated {table_name} in {db_path} to the typed schema")
+    return True
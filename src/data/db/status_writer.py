@@ -0,0 +1,157 @@
+"""
+Writer stage for the results of the reconciled emails, so that the
+workers don't contend for the database lock and commit every row
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+from src.misc.beautified_logging import BeautifiedLogging
+
+logging = BeautifiedLogging()
+
+TABLE_NAME = "emails"
+
+
+def update_email_rows(conn: sqlite3.Connection, rows: list[tuple[str, dict[str, Any]]]):
+    """
+    Save the results of several emails in one transaction
+
+    Rows are (email_id, data_to_save) tuples
+    """
+    with conn:
+        for set_clause, parameters in group_email_rows(rows).items():
+            conn.executemany(
+                f"UPDATE {TABLE_NAME} SET {set_clause} WHERE email_id = ?",
+                parameters,
+            )
+
+
+def group_email_rows(
+    rows: list[tuple[str, dict[str, Any]]],
+) -> dict[str, list[list[Any]]]:
+    """Group the rows by the columns they set, one executemany per group"""
+    groups = {}
+    for email_id, data_to_save in rows:
+        set_clause = ", ".join(f"{key} = ?" for key in data_to_save.keys())
+        groups.setdefault(set_clause, []).append([*data_to_save.values(), email_id])
+    return groups
+
+
+class EmailStatusWriter:
+    """
+    Queues the results of the emails and flushes them with write_batch
+    from a single thread, once batch_size rows are queued or
+    flush_interval_ms has passed since the first queued row
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[list[tuple[str, dict[str, Any]]]], None],
+        batch_size: int = 50,
+        flush_interval_ms: float = 200,
+    ):
+        self.write_batch = write_batch
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval_ms / 1000
+
+        self.__queue: queue.Queue = queue.Queue()
+        self.__thread = None
+        self.__stop = object()
+
+        self.flushes = 0
+        self.rows = 0
+        self.failed_rows = 0
+        self.flush_latencies: list[float] = []
+
+    def put(self, email_id: str, data_to_save: dict[str, Any]):
+        """Queue the results of an email"""
+        self.__queue.put((email_id, data_to_save))
+
+    def __flush(self, rows: list[tuple[str, dict[str, Any]]]):
+        start_time = time.perf_counter()
+        try:
+            self.write_batch(rows)
+        except Exception as e:
+            # the writer keeps running for the next results, i.e. after
+            # a locked database or a result that cannot be serialized
+            self.failed_rows += len(rows)
+            logging.error(
+                "Writer",
+                f"Failed to save {len(rows)} emails: {e!r}\n"
+                f"{[email_id for email_id, _ in rows]}",
+            )
+            return
+
+        self.flush_latencies.append((time.perf_counter() - start_time) * 1000)
+        self.flushes += 1
+        self.rows += len(rows)
+
+    def __run(self):
+        rows = []
+        deadline = None
+        stopped = False
+        while not stopped:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.__queue.get(timeout=timeout)
+                if item is self.__stop:
+                    stopped = True
+                else:
+                    rows.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if rows and (
+                stopped or len(rows) >= self.batch_size or time.monotonic() >= deadline
+            ):
+                self.__flush(rows)
+                rows = []
+                deadline = None
+
+    def start(self):
+        """Start the writer thread"""
+        self.__thread = threading.Thread(
+            target=self.__run, name="email-status-writer", daemon=True
+        )
+        self.__thread.start()
+
+    def close(self):
+        """Flush the queued results, stop the writer thread and report the metrics"""
+        if self.__thread is None:
+            return
+
+        self.__queue.put(self.__stop)
+        self.__thread.join()
+        self.__thread = None
+
+        logging.info("Writer", self.report())
+
+    def metrics(self) -> dict[str, float]:
+        """Flush counts and latencies in milliseconds"""
+        latencies = sorted(self.flush_latencies)
+        return {
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "failed_rows": self.failed_rows,
+            "rows_per_flush": self.rows / self.flushes if self.flushes else 0,
+            "mean_latency_ms": sum(latencies) / len(latencies) if latencies else 0,
+            "p95_latency_ms": (
+                latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0
+            ),
+            "max_latency_ms": latencies[-1] if latencies else 0,
+        }
+
+    def report(self) -> str:
+        """Metrics report for the logs"""
+        metrics = self.metrics()
+        return f"""
+            Saved {metrics["rows"]} emails in {metrics["flushes"]} flushes ({metrics["rows_per_flush"]:.1f} per flush)
+            Failed: {metrics["failed_rows"]}
+            Flush latency: mean {metrics["mean_latency_ms"]:.2f} ms, p95 {metrics["p95_latency_ms"]:.2f} ms, max {metrics["max_latency_ms"]:.2f} ms
+            """
@@ -0,0 +1,327 @@
+"""
+Exact and near duplicate detection of the attachments, so that resent
+screenshots share one OCR result and the duplicate emails of an invoice
+that is already paid are flagged before the agent graph
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any
+
+import numpy as np
+from langchain_core.messages import AIMessage, HumanMessage
+from PIL import Image, ImageChops, UnidentifiedImageError
+
+from src.data.db.attachment_index import (
+    create_attachment_index_table,
+    load_attachment_index,
+    save_attachment_index,
+)
+from src.data.db.attachment_text import split_attachments
+from src.data.db.connection_pool import get_connection
+from src.data.db.invoice_index import get_invoice_index
+from src.llm.agents.email_agent.fast_path import INVOICE_ID_PATTERN
+from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.tracing import span
+
+logging = BeautifiedLogging()
+
+TRANSACTION_TABLE_NAME = "transactions"
+
+# 256 bit difference hash, the 64 bit one cannot tell apart
+# screenshots made from the same template
+DHASH_SIZE = 16
+
+# near duplicates by dhash are confirmed on the pixels, as the digits that
+# set two payment screenshots apart barely change the hash: a resent copy
+# has next to no pixels changed by more than half the gray scale
+PIXEL_DIFF_THRESHOLD = 128
+MAX_CHANGED_PIXELS = 0.001
+
+# screenshots of one template are often within a few bits of each other,
+# so the candidates are first compared on thumbnails kept in memory: no
+# pixel of a recompressed or resized copy moves by more than
+# THUMBNAIL_MAX_DIFF, against 0.5% of the distinct screenshots
+THUMBNAIL_SIZE = 48
+THUMBNAIL_MAX_DIFF = 40
+
+
+def dhash(image: Image.Image) -> int:
+    """Difference hash of the image, one bit per pair of neighbouring pixels"""
+    pixels = (
+        image.convert("L")
+        .resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.LANCZOS)
+        .tobytes()
+    )
+    value = 0
+    for row in range(DHASH_SIZE):
+        for column in range(DHASH_SIZE):
+            index = row * (DHASH_SIZE + 1) + column
+            value = (value << 1) | (pixels[index] > pixels[index + 1])
+    return value
+
+
+def changed_pixels(image: Image.Image, other: Image.Image) -> float:
+    """Share of the pixels changed by more than PIXEL_DIFF_THRESHOLD"""
+    other = other.resize(image.size, Image.Resampling.LANCZOS)
+    histogram = ImageChops.difference(image, other).histogram()
+    return sum(histogram[PIXEL_DIFF_THRESHOLD:]) / (image.width * image.height)
+
+
+def thumbnail(image: Image.Image) -> np.ndarray:
+    """Pixels of the gray scale image scaled down to THUMBNAIL_SIZE squared"""
+    return np.asarray(
+        image.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX),
+        dtype=np.int16,
+    ).ravel()
+
+
+class AttachmentIndexer:
+    """
+    Indexes the attachments not in the attachment_index table of emails.db,
+    mapping each one to the first attachment with the same content or,
+    within max_distance bits of the 256 bit dhash and the same pixels,
+    the same image
+    """
+
+    def __init__(
+        self, email_db_path: str, attachments_path: str, max_distance: int = 24
+    ):
+        self.email_db_path = email_db_path
+        self.attachments_path = attachments_path
+        self.max_distance = max_distance
+
+        # aspect ratio and thumbnail of the canonical attachments,
+        # made on their first comparison
+        self.thumbnails: dict[str, tuple[float, np.ndarray]] = {}
+
+    def __gray_image(self, attachment: str, draft: bool = False) -> Image.Image:
+        with Image.open(f"{self.attachments_path}/{attachment}") as image:
+            if draft:
+                # JPEGs decoded straight to gray scale, faster but with
+                # slightly different pixels, so only used for the pixel check
+                image.draft("L", image.size)
+            return image.convert("L")
+
+    def __thumbnail(self, attachment: str) -> tuple[float, np.ndarray]:
+        if attachment not in self.thumbnails:
+            image = self.__gray_image(attachment)
+            self.thumbnails[attachment] = (image.width / image.height, thumbnail(image))
+        return self.thumbnails[attachment]
+
+    def __near_duplicate(
+        self, image: Image.Image, value: int, canonicals: list[tuple[str, int]]
+    ) -> str:
+        aspect_ratio = image.width / image.height
+        candidates = []
+        for canonical, canonical_value in canonicals:
+            if bin(value ^ canonical_value).count("1") > self.max_distance:
+                continue
+            canonical_aspect_ratio, canonical_thumbnail = self.__thumbnail(canonical)
+            if abs(aspect_ratio - canonical_aspect_ratio) <= 0.02 * aspect_ratio:
+                candidates.append((canonical, canonical_thumbnail))
+        if not candidates:
+            return None
+
+        differences = np.abs(
+            np.stack([canonical_thumbnail for _, canonical_thumbnail in candidates])
+            - thumbnail(image)
+        ).max(axis=1)
+        for (canonical, _), difference in zip(candidates, differences):
+            if difference > THUMBNAIL_MAX_DIFF:
+                continue
+
+            canonical_image = self.__gray_image(canonical, draft=True)
+            if changed_pixels(image, canonical_image) <= MAX_CHANGED_PIXELS:
+                return canonical
+        return None
+
+    def run(self):
+        """Index the new attachments"""
+        start_time = time.perf_counter()
+
+        conn = sqlite3.connect(self.email_db_path, timeout=30)
+        try:
+            create_attachment_index_table(conn)
+            index = load_attachment_index(conn)
+
+            by_sha256 = {}
+            canonicals = []
+            for attachment, (sha256, value, canonical, _) in index.items():
+                if canonical != attachment:
+                    continue
+                by_sha256[sha256] = attachment
+                if value:
+                    canonicals.append((attachment, int(value, 16)))
+
+            rows = []
+            with span("index_attachments", "stage"):
+                for attachment in sorted(os.listdir(self.attachments_path)):
+                    if attachment in index:
+                        continue
+
+                    with open(f"{self.attachments_path}/{attachment}", "rb") as file:
+                        sha256 = hashlib.sha256(file.read()).hexdigest()
+                    if sha256 in by_sha256:
+                        rows.append(
+                            (attachment, sha256, None, by_sha256[sha256], "exact")
+                        )
+                        continue
+
+                    try:
+                        image = self.__gray_image(attachment)
+                        value = dhash(image)
+                    except (UnidentifiedImageError, OSError):
+                        # i.e. PDFs, only their exact duplicates are detected
+                        by_sha256[sha256] = attachment
+                        rows.append((attachment, sha256, None, attachment, None))
+                        continue
+
+                    canonical = self.__near_duplicate(image, value, canonicals)
+                    if canonical is not None:
+                        rows.append(
+                            (attachment, sha256, f"{value:x}", canonical, "near")
+                        )
+                        continue
+
+                    by_sha256[sha256] = attachment
+                    canonicals.append((attachment, value))
+                    rows.append((attachment, sha256, f"{value:x}", attachment, None))
+
+            save_attachment_index(conn, rows)
+        finally:
+            conn.close()
+
+        exact = sum(1 for row in rows if row[4] == "exact")
+        near = sum(1 for row in rows if row[4] == "near")
+        logging.info(
+            "Dedup",
+            f"""
+            Indexed {len(rows)} attachments in {time.perf_counter() - start_time:.1f} s
+            Exact duplicates: {exact}, near duplicates: {near}
+            """,
+        )
+
+
+class DuplicateChecker:
+    """
+    Flags the emails whose attachment is shared with another email, directly
+    or as a duplicate, when the invoice they mention is already PAID
+
+    Every other email is a miss and is left to the fast path and the graph
+    """
+
+    def __init__(self, email_db_path: str, transaction_db_path: str):
+        self.transaction_db_path = transaction_db_path
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        conn = sqlite3.connect(email_db_path, timeout=30)
+        try:
+            self.canonicals = {
+                attachment: row[2]
+                for attachment, row in load_attachment_index(conn).items()
+            }
+            # number of emails sharing each canonical attachment
+            self.email_counts: dict[str, int] = {}
+            for (attachments,) in conn.execute(
+                "SELECT attachments FROM emails WHERE attachments != ''"
+            ):
+                for canonical in {
+                    self.canonicals.get(attachment, attachment)
+                    for attachment in split_attachments(attachments)
+                }:
+                    self.email_counts[canonical] = self.email_counts.get(canonical, 0) + 1
+        finally:
+            conn.close()
+
+    def __invoice_state(self, invoice_id: str) -> str:
+        with span("duplicate_lookup", "db", db=TRANSACTION_TABLE_NAME, invoice_id=invoice_id):
+            invoice_index = get_invoice_index(self.transaction_db_path)
+            if invoice_index is not None:
+                rows = invoice_index.lookup(invoice_id, ["reconciliation_state"])
+                return rows[0][0] if len(rows) == 1 else None
+
+            rows = (
+                get_connection(self.transaction_db_path, read_only=True)
+                .execute(
+                    f"""
+                    SELECT reconciliation_state FROM {TRANSACTION_TABLE_NAME}
+                    WHERE invoice_id = ?
+                    """,
+                    (invoice_id,),
+                )
+                .fetchall()
+            )
+        return rows[0][0] if len(rows) == 1 else None
+
+    def __miss(self, result: dict[str, Any]) -> dict[str, Any]:
+        with self.lock:
+            self.misses += 1
+        return {**result, "status": "MISS", "response": "MISS"}
+
+    def check(
+        self, email_text: str, subject: str, body: str, attachment: str
+    ) -> dict[str, Any]:
+        """
+        Check an email, returns the status DONE for a duplicate of a paid
+        invoice and MISS otherwise, along with the response and chat history
+        """
+        result = {
+            "status": "",
+            "response": "",
+            "usage": {},
+            "chat_history": [],
+        }
+
+        attachments = split_attachments(attachment)
+        if len(attachments) != 1:
+            return self.__miss(result)
+        canonical = self.canonicals.get(attachments[0], attachments[0])
+        if self.email_counts.get(canonical, 0) < 2:
+            return self.__miss(result)
+
+        invoice_ids = set(INVOICE_ID_PATTERN.findall(f"{subject}\n{body}"))
+        if len(invoice_ids) != 1:
+            return self.__miss(result)
+        invoice_id = invoice_ids.pop()
+        if self.__invoice_state(invoice_id) != "PAID":
+            return self.__miss(result)
+
+        with self.lock:
+            self.hits += 1
+
+        response = (
+            f"DUPLICATE: attachment {attachments[0]} was already sent as {canonical}, "
+            f"invoice {invoice_id} is already PAID"
+        )
+        result["chat_history"] = [
+            HumanMessage(content=email_text),
+            AIMessage(
+                content=response,
+                additional_kwargs={
+                    "sender": "duplicate_check",
+                    "timestamp": datetime.now().isoformat(),
+                },
+                response_metadata={"model_name": "rules"},
+                usage_metadata={
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "total_tokens": 0,
+                },
+            ),
+        ]
+        return {**result, "status": "DONE", "response": response}
+
+    def report(self) -> str:
+        """Duplicate report for the logs"""
+        with self.lock:
+            return f"""
+            Duplicates of paid invoices: {self.hits}/{self.hits + self.misses}
+            """
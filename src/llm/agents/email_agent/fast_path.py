@@ -0,0 +1,167 @@
+"""
+Rule based reconciliation of the emails following the
+"Payment Confirmation for Invoice ID: NNNNN" pattern,
+so that only the ambiguous emails need the agent graph
+"""
+
+import json
+import re
+import threading
+from datetime import datetime
+from typing import Any
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from src.data.db.connection_pool import get_connection
+from src.data.db.invoice_index import get_invoice_index
+from src.llm.agents.email_agent.ocr_schema import structured_ocr_fields
+from src.llm.agents.email_agent.tools import run_ocr
+from src.llm.agents.sql_agent.tools import update_invoice
+from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.tracing import span
+
+logging = BeautifiedLogging()
+
+TABLE_NAME = "transactions"
+
+INVOICE_ID_PATTERN = re.compile(r"Invoice ID\s*:?\s*#?\s*(\d+)", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)")
+
+
+class FastPathReconciler:
+    """
+    Reconciles an email without LLM turns when the invoice id in the
+    subject and body is unambiguous, the invoice exists and is not paid yet,
+    and the amounts read from the attachment match the invoice amount
+
+    Every other email is a miss and is left to the agent graph
+    """
+
+    def __init__(self, transaction_db_path: str):
+        self.transaction_db_path = transaction_db_path
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses: dict[str, int] = {}
+
+    def __lookup_invoice(self, invoice_id: str) -> list[tuple]:
+        with span("fast_path_lookup", "db", db=TABLE_NAME, invoice_id=invoice_id):
+            invoice_index = get_invoice_index(self.transaction_db_path)
+            if invoice_index is not None:
+                return invoice_index.lookup(
+                    invoice_id, ["invoice_id", "amount", "reconciliation_state"]
+                )
+
+            return (
+                get_connection(self.transaction_db_path, read_only=True)
+                .execute(
+                    f"""
+                    SELECT invoice_id, amount, reconciliation_state
+                    FROM {TABLE_NAME} WHERE invoice_id = ?
+                    """,
+                    (invoice_id,),
+                )
+                .fetchall()
+            )
+
+    def __miss(self, result: dict[str, Any], reason: str) -> dict[str, Any]:
+        with self.lock:
+            self.misses[reason] = self.misses.get(reason, 0) + 1
+        return {**result, "status": "MISS", "response": f"MISS: {reason}"}
+
+    def reconcile(
+        self, email_text: str, subject: str, body: str, attachment: str
+    ) -> dict[str, Any]:
+        """
+        Reconcile an email, returns the status DONE on a hit and MISS otherwise,
+        along with the response, usage and chat history of the attempt
+        """
+        result = {
+            "status": "",
+            "response": "",
+            "usage": {},
+            "chat_history": [],
+        }
+
+        invoice_ids = set(INVOICE_ID_PATTERN.findall(f"{subject}\n{body}"))
+        if len(invoice_ids) != 1:
+            return self.__miss(result, "invoice_id")
+        invoice_id = invoice_ids.pop()
+
+        if not attachment or "," in attachment:
+            return self.__miss(result, "attachment")
+
+        invoices = self.__lookup_invoice(invoice_id)
+        if len(invoices) != 1:
+            return self.__miss(result, "not_in_db")
+        _, invoice_amount, reconciliation_state = invoices[0]
+        if reconciliation_state == "PAID":
+            return self.__miss(result, "already_paid")
+
+        try:
+            ocr_result = run_ocr(attachment)
+        except Exception as e:
+            logging.error("Fast path", f"OCR failed: {e}")
+            return self.__miss(result, "ocr_error")
+        result["usage"] = ocr_result["usage"]
+        result["chat_history"].append(
+            ToolMessage(
+                content=json.dumps(ocr_result), name="ocr_tool", tool_call_id=attachment
+            )
+        )
+
+        ocr_text = ocr_result["content"]
+        ocr_fields = structured_ocr_fields(ocr_text)
+        if ocr_fields is not None:
+            ocr_invoice_ids = [ocr_fields.invoice_id] if ocr_fields.invoice_id else []
+            amounts = {ocr_fields.amount} if ocr_fields.amount is not None else set()
+        else:
+            ocr_invoice_ids = INVOICE_ID_PATTERN.findall(ocr_text)
+            amounts = {
+                float(amount.replace(",", ""))
+                for amount in AMOUNT_PATTERN.findall(ocr_text)
+            }
+
+        if any(ocr_id != invoice_id for ocr_id in ocr_invoice_ids):
+            return self.__miss(result, "ocr_invoice_id")
+
+        if not amounts or any(
+            abs(amount - invoice_amount) >= 0.005 for amount in amounts
+        ):
+            return self.__miss(result, "amount")
+
+        update_result = update_invoice(invoice_id, f"{email_text}\nOCR: {ocr_text}")
+        if update_result["content"] != "DONE":
+            return self.__miss(result, "update")
+
+        with self.lock:
+            self.hits += 1
+
+        result["chat_history"] = [
+            HumanMessage(content=email_text),
+            *result["chat_history"],
+            AIMessage(
+                content=f"UPDATE invoice {invoice_id}, amount ${invoice_amount:,.2f} matches",
+                additional_kwargs={
+                    "sender": "fast_path",
+                    "timestamp": datetime.now().isoformat(),
+                },
+                response_metadata={"model_name": "rules"},
+                usage_metadata={
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "total_tokens": 0,
+                },
+            ),
+        ]
+        return {**result, "status": "DONE", "response": update_result["content"]}
+
+    def report(self) -> str:
+        """Hit rate report for the logs"""
+        with self.lock:
+            total = self.hits + sum(self.misses.values())
+            hit_rate = self.hits / total if total else 0
+            return f"""
+            Fast path hits: {self.hits}/{total} ({hit_rate:.2%})
+            Misses: {self.misses}
+            """
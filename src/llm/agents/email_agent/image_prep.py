@@ -0,0 +1,149 @@
+"""
+Downscaling and recompression of the attachments before they are sent
+to the vision model, with the bytes and latency of the OCR inputs per model
+"""
+
+import io
+import math
+import os
+import threading
+import time
+from typing import Any
+
+from PIL import Image, ImageStat, UnidentifiedImageError
+
+# mean HSV saturation (0-255) under which dropping the colors keeps the text readable
+GRAYSCALE_MAX_SATURATION = 24
+
+
+def image_prep_settings() -> dict[str, Any]:
+    """Preprocessing settings from the environment, None when disabled"""
+    if os.getenv("OCR_IMAGE_PREP") != "true":
+        return None
+
+    return {
+        "max_side": int(os.getenv("OCR_IMAGE_MAX_SIDE", "1568") or 0),
+        "max_pixels": int(os.getenv("OCR_IMAGE_MAX_PIXELS", "0") or 0),
+        "grayscale": os.getenv("OCR_IMAGE_GRAYSCALE", "auto"),
+        "quality": int(os.getenv("OCR_IMAGE_QUALITY", "85")),
+    }
+
+
+def image_prep_version() -> str:
+    """Settings as a string, so that the OCR cache keeps the inputs of each setting apart"""
+    settings = image_prep_settings()
+    if settings is None:
+        return ""
+    return ";" + ";".join(f"{key}={value}" for key, value in settings.items())
+
+
+def is_grayscale_safe(image: Image.Image) -> bool:
+    """Whether the image is close enough to grayscale to drop its colors"""
+    thumbnail = image.convert("RGB").resize((64, 64))
+    saturation = ImageStat.Stat(thumbnail.convert("HSV")).mean[1]
+    return saturation < GRAYSCALE_MAX_SATURATION
+
+
+def prepare_image(data: bytes, mime_type: str) -> tuple[bytes, str, dict[str, Any]]:
+    """
+    Resize the image to the max side and pixel budget, convert it to grayscale
+    when that is safe and recompress it as JPEG
+
+    Returns the bytes and mime type to send along with the stats of the step.
+    The original is sent when preprocessing is disabled, the file is not an
+    image or the result would not be smaller
+    """
+    stats = {
+        "original_bytes": len(data),
+        "bytes": len(data),
+        "prep_ms": 0,
+        "resized": False,
+        "grayscale": False,
+    }
+
+    settings = image_prep_settings()
+    if settings is None:
+        return data, mime_type, stats
+
+    start_time = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return data, mime_type, stats
+
+    width, height = image.size
+    scale = 1.0
+    if settings["max_side"] > 0:
+        scale = min(scale, settings["max_side"] / max(width, height))
+    if settings["max_pixels"] > 0:
+        scale = min(scale, math.sqrt(settings["max_pixels"] / (width * height)))
+    if scale < 1:
+        image = image.resize(
+            (max(round(width * scale), 1), max(round(height * scale), 1)),
+            Image.Resampling.LANCZOS,
+        )
+        stats["resized"] = True
+
+    if settings["grayscale"] == "true" or (
+        settings["grayscale"] == "auto" and is_grayscale_safe(image)
+    ):
+        image = image.convert("L")
+        stats["grayscale"] = True
+    else:
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=settings["quality"], optimize=True)
+    stats["prep_ms"] = (time.perf_counter() - start_time) * 1000
+
+    if output.tell() >= len(data) and not stats["resized"]:
+        stats["grayscale"] = False
+        return data, mime_type, stats
+
+    stats["bytes"] = output.tell()
+    return output.getvalue(), "image/jpeg", stats
+
+
+class OcrInputStats:
+    """Bytes sent and request latency of the OCR inputs, per vision model"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models: dict[str, dict[str, float]] = {}
+
+    def record(self, model: str, image_stats: dict[str, Any], request_ms: float):
+        """Add the stats of an OCR request"""
+        with self.lock:
+            totals = self.models.setdefault(
+                model,
+                {
+                    "images": 0,
+                    "original_bytes": 0,
+                    "bytes": 0,
+                    "prep_ms": 0,
+                    "request_ms": 0,
+                },
+            )
+            totals["images"] += 1
+            totals["original_bytes"] += image_stats["original_bytes"]
+            totals["bytes"] += image_stats["bytes"]
+            totals["prep_ms"] += image_stats["prep_ms"]
+            totals["request_ms"] += request_ms
+
+    def report(self) -> str:
+        """Report of the OCR inputs for the logs"""
+        with self.lock:
+            lines = []
+            for model, totals in self.models.items():
+                images = totals["images"]
+                saved = 1 - totals["bytes"] / totals["original_bytes"]
+                lines.append(
+                    f"{model}: {images} images, "
+                    f"{totals['original_bytes'] / images / 1024:.1f} kB -> {totals['bytes'] / images / 1024:.1f} kB ({saved:.1%} saved), "
+                    f"prep {totals['prep_ms'] / images:.1f} ms, request {totals['request_ms'] / images:.0f} ms mean"
+                )
+            return "\n".join(lines)
+
+
+ocr_input_stats = OcrInputStats()
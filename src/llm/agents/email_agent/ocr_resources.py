@@ -0,0 +1,82 @@
+"""
+Process-wide resources of the OCR tool, created once and shared by every call
+"""
+
+import os
+import threading
+
+import magic
+from langchain_core.messages import HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from src.llm.models import ModelRouter
+
+
+class OcrResources:
+    """
+    libmagic and the vision model client of the OCR tool
+
+    The client keeps its HTTP connection pool, so the requests reuse the
+    keep-alive connections to the vision endpoint. The router of the
+    registry counts the usage of the process, the usage of a single call
+    is collected by the callbacks passed to the chain with the call
+    """
+
+    def __init__(self, vision_model: str):
+        self.vision_model = vision_model
+
+        # magic.Magic holds a lock around every lookup, so it can be shared
+        self.mime = magic.Magic(mime=True)
+
+        self.router = ModelRouter()
+        llm_model = self.router.get_model(
+            model_type=vision_model, temperature=0, is_vision=True
+        )
+        self.provider = llm_model["provider"]
+        self.model = llm_model["model"]
+
+        self.chain = RunnableLambda(self.__messages) | self.model | StrOutputParser()
+
+    def __messages(self, data: dict) -> list[HumanMessage]:
+        img_data_str = f"data:{data['mime_type']};base64,{data['image']}"
+
+        return [
+            HumanMessage(
+                content=[
+                    {
+                        "type": "image_url",
+                        "image_url": (
+                            {"url": img_data_str}
+                            if self.provider == "openai"
+                            else img_data_str
+                        ),
+                    },
+                    {"type": "text", "text": data["prompt"]},
+                ]
+            )
+        ]
+
+    def mime_type(self, file_path: str) -> str:
+        """Mime type of the file"""
+        return self.mime.from_file(file_path)
+
+
+_resources: dict[str, OcrResources] = {}
+_resources_lock = threading.Lock()
+
+
+def get_ocr_resources() -> OcrResources:
+    """
+    Get the shared OCR resources of the vision model
+
+    Resources are identified by the VISION_MODEL and VISION_BASE_URL
+    environment variables, and created on first use
+    """
+    vision_model = os.environ["VISION_MODEL"]
+    key = f"{vision_model}:{os.getenv('VISION_BASE_URL', '')}"
+
+    with _resources_lock:
+        if key not in _resources:
+            _resources[key] = OcrResources(vision_model)
+        return _resources[key]
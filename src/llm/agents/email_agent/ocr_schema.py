@@ -0,0 +1,97 @@
+"""
+Structured OCR mode, where the vision model returns the invoice fields
+as JSON instead of a free-form transcription
+"""
+
+import json
+import os
+import re
+from typing import Optional
+
+from pydantic import BaseModel, field_validator
+
+STRUCTURED_OCR_PROMPT = """Act as an OCR assistant. Analyze the provided image of a payment or invoice and
+    extract the following fields as a JSON object:
+    - invoice_id: the invoice id, digits only
+    - amount: the paid or invoiced amount as a number, without currency symbol or thousands separator
+    - currency: the ISO 4217 currency code, i.e. USD
+    - dates: the dates shown in the image, as written
+    - payer: the name of the person or company paying
+    - payee: the name of the person or company being paid
+    Use null for the fields that are not in the image.
+    Provide only the JSON object without any additional comments."""
+
+# currency symbols the model may return instead of the code
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY"}
+
+
+class InvoiceFields(BaseModel):
+    """Fields of an invoice or payment read from an attachment"""
+
+    invoice_id: Optional[str] = None
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+    dates: list[str] = []
+    payer: Optional[str] = None
+    payee: Optional[str] = None
+
+    @field_validator("invoice_id", mode="before")
+    @classmethod
+    def parse_invoice_id(cls, value):
+        if value is None:
+            return None
+        invoice_id = re.sub(r"^\s*(invoice\s*id)?\s*:?\s*#?\s*", "", str(value), flags=re.I)
+        return invoice_id.strip() or None
+
+    @field_validator("amount", mode="before")
+    @classmethod
+    def parse_amount(cls, value):
+        if isinstance(value, str):
+            value = re.sub(r"[^\d.\-]", "", value)
+            return float(value) if value else None
+        return value
+
+    @field_validator("currency", mode="before")
+    @classmethod
+    def parse_currency(cls, value):
+        if value is None:
+            return None
+        currency = CURRENCY_SYMBOLS.get(str(value).strip(), str(value).strip().upper())
+        if not re.fullmatch(r"[A-Z]{3}", currency):
+            raise ValueError(f"Invalid currency {value}")
+        return currency
+
+    @field_validator("dates", mode="before")
+    @classmethod
+    def parse_dates(cls, value):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [value]
+        return [str(date) for date in value if date]
+
+
+def ocr_mode() -> str:
+    """OCR_MODE from the environment, text (default) or structured"""
+    return os.getenv("OCR_MODE", "text")
+
+
+def parse_invoice_fields(response: str) -> InvoiceFields:
+    """
+    Validate the JSON answer of the vision model, allowing for a markdown
+    code fence around it, raises ValueError when it does not match the schema
+    """
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    if match is None:
+        raise ValueError("No JSON object in the OCR response")
+    return InvoiceFields.model_validate(json.loads(match.group(0)))
+
+
+def structured_ocr_fields(content: str) -> Optional[InvoiceFields]:
+    """Fields of an OCR tool result produced in structured mode, None for a transcription"""
+    if not content.lstrip().startswith("{"):
+        return None
+    try:
+        return InvoiceFields.model_validate_json(content)
+    except ValueError:
+        return None
@@ -0,0 +1,52 @@
+"""
+Text layer and embedded images of the PDF attachments
+"""
+
+import io
+import os
+
+from pypdf import PdfReader
+
+PDF_MIME_TYPE = "application/pdf"
+
+IMAGE_MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+
+def min_text_chars() -> int:
+    """Characters a page needs in its text layer to skip the vision model"""
+    return int(os.getenv("PDF_MIN_TEXT_CHARS", "20"))
+
+
+def _image_bytes(pdf_image) -> tuple[bytes, str]:
+    extension = os.path.splitext(pdf_image.name)[1].lower()
+    if extension in IMAGE_MIME_TYPES:
+        return pdf_image.data, IMAGE_MIME_TYPES[extension]
+
+    # i.e. JPEG 2000 or TIFF, which the vision models may not accept
+    output = io.BytesIO()
+    pdf_image.image.convert("RGB").save(output, format="PNG")
+    return output.getvalue(), "image/png"
+
+
+def read_pdf_pages(data: bytes) -> list[dict]:
+    """
+    Pages of the PDF with the text of their text layer, and the embedded
+    images of the pages without one as (bytes, mime type) tuples
+    """
+    reader = PdfReader(io.BytesIO(data))
+
+    pages = []
+    for page in reader.pages:
+        text = (page.extract_text() or "").strip()
+        if len("".join(text.split())) >= min_text_chars():
+            pages.append({"text": text, "images": []})
+            continue
+
+        pages.append(
+            {
+                "text": "",
+                "images": [_image_bytes(pdf_image) for pdf_image in page.images],
+            }
+        )
+    return pages
+
@@ -0,0 +1,109 @@
+"""
+Pipeline stage extracting the text of every attachment referenced in
+emails.db before the reconciliation, so that the vision model runs in one
+burst and the graph reads the precomputed text instead
+"""
+
+import contextvars
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.data.db.attachment_text import (
+    create_attachment_text_table,
+    pending_attachments,
+    save_attachment_texts,
+)
+from src.llm.agents.email_agent.tools import ocr_version, run_ocr
+from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.tracing import span
+
+logging = BeautifiedLogging()
+
+
+class AttachmentTextExtractor:
+    """
+    OCRs the attachments without text in the attachment_text table
+    of emails.db with a pool of worker threads, saving the results
+    in batches of flush_rows from the calling thread
+
+    The texts are saved under the current ocr_version, the ones of
+    another OCR mode or prompt are extracted again
+    """
+
+    def __init__(self, email_db_path: str, workers: int = 8, flush_rows: int = 50):
+        self.email_db_path = email_db_path
+        self.workers = max(workers, 1)
+        self.flush_rows = max(flush_rows, 1)
+
+        self.extracted = 0
+        self.failed: list[str] = []
+        self.usage: dict[str, float] = {}
+        self.ocr_version = ocr_version()
+
+    def __add_usage(self, usage: dict[str, float]):
+        for key, value in usage.items():
+            self.usage[key] = self.usage.get(key, 0) + value
+
+    def run(self):
+        """Extract the pending attachments"""
+        conn = sqlite3.connect(self.email_db_path, timeout=30)
+        try:
+            create_attachment_text_table(conn)
+            attachments = pending_attachments(conn, self.ocr_version)
+
+            logging.info(
+                "Pre-OCR",
+                f"Extracting {len(attachments)} attachments with {self.workers} workers",
+            )
+
+            start_time = time.perf_counter()
+            with span("pre_ocr", "stage", attachments=len(attachments)):
+                self.__extract(conn, attachments)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            conn.close()
+
+        logging.info("Pre-OCR", self.report(elapsed))
+
+    def __extract(self, conn: sqlite3.Connection, attachments: list[str]):
+        rows = []
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="pre-ocr"
+        ) as executor:
+            # the OCR spans are children of the pre_ocr span
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, run_ocr, attachment
+                ): attachment
+                for attachment in attachments
+            }
+            for future in as_completed(futures):
+                attachment = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # left to the ocr tool of the graph
+                    logging.error("Pre-OCR", f"OCR failed for {attachment}: {e}")
+                    self.failed.append(attachment)
+                    continue
+
+                self.__add_usage(result["usage"])
+                rows.append((attachment, result["content"], result["usage"]))
+                if len(rows) >= self.flush_rows:
+                    save_attachment_texts(conn, rows, self.ocr_version)
+                    self.extracted += len(rows)
+                    rows = []
+
+        if rows:
+            save_attachment_texts(conn, rows, self.ocr_version)
+            self.extracted += len(rows)
+
+    def report(self, elapsed: float) -> str:
+        """Extraction report for the logs"""
+        rate = self.extracted / elapsed if elapsed else 0
+        return f"""
+            Extracted: {self.extracted} in {elapsed:.1f} s ({rate:.2f} per second)
+            Failed: {len(self.failed)} {self.failed}
+            Vision usage: {self.usage}
+            """
@@ -3,16 +3,33 @@ Tool set for the agent who is in
 charge of querying the invoice db
 """
 
+import asyncio
 import base64
 import os
-import magic
+import time
 
 from dotenv import load_dotenv
-from langchain.tools import tool
-from langchain_core.messages import HumanMessage
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
+from langchain_core.tools import StructuredTool
+from src.data.db.attachment_index import get_canonical_attachment
+from src.data.db.attachment_text import get_attachment_text
+from src.data.db.ocr_cache import content_hash, get_ocr_cache
+from src.llm.agents.email_agent.image_prep import (
+    image_prep_version,
+    ocr_input_stats,
+    prepare_image,
+)
+from src.llm.agents.email_agent.ocr_resources import get_ocr_resources
+from src.llm.agents.email_agent.pdf_attachments import PDF_MIME_TYPE, read_pdf_pages
+from src.llm.agents.email_agent.ocr_schema import (
+    STRUCTURED_OCR_PROMPT,
+    ocr_mode,
+    parse_invoice_fields,
+)
 from src.llm.models import ModelRouter
 from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.path_parser import get_db_path
+from src.misc.tracing import span
 
 load_dotenv()
 cwd = os.getcwd()
@@ -20,18 +37,78 @@ cwd = os.getcwd()
 logging = BeautifiedLogging()
 
 
-@tool
-def ocr_tool(image_path: str) -> str:
-    """OCR tools parse invoice images to produce useful data for reconciliation"""
-
-    file_path = f"{cwd}/dataset/attachments/{image_path}"
-
-    ocr_prompt = """Act as an OCR assistant. Analyze the provided image and:
+OCR_PROMPT = """Act as an OCR assistant. Analyze the provided image and:
     1. Recognize all visible text in the image as accurately as possible.
     2. Maintain the original structure and formatting of the text.
     3. If any words or phrases are unclear, indicate this with [unclear] in your transcription.
     Provide only the transcription without any additional comments."""
 
+# part of the OCR cache key along with the image preprocessing settings,
+# bump them whenever the prompts change
+OCR_PROMPT_VERSION = "1"
+STRUCTURED_OCR_PROMPT_VERSION = "structured-1"
+
+NO_USAGE = {
+    "successful_requests": 0,
+    "total_tokens": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "total_cost": 0,
+}
+
+
+def _ocr_prompt() -> tuple[str, str]:
+    """Prompt of the OCR mode and its version"""
+    if ocr_mode() == "structured":
+        return STRUCTURED_OCR_PROMPT, STRUCTURED_OCR_PROMPT_VERSION
+    return OCR_PROMPT, OCR_PROMPT_VERSION
+
+
+def ocr_version() -> str:
+    """Version of the OCR output, from the prompt of the OCR mode and the image preprocessing"""
+    return f"{_ocr_prompt()[1]}{image_prep_version()}"
+
+
+def _stored_ocr(image_path: str) -> tuple[tuple[str, str, str], dict, str]:
+    """
+    Looks up the text of the attachment precomputed in attachment_text, then
+    in the OCR cache, returns the cache key, the stored result and its source
+    """
+    # no request is made to the vision model for a stored text
+    text = get_attachment_text(
+        f"{get_db_path()}/emails.db", image_path, ocr_version()
+    )
+    if text is not None:
+        logging.info("Tool", f"Precomputed OCR text for {image_path}")
+        return None, {"content": text, "usage": dict(NO_USAGE)}, "attachment_text"
+
+    cache = get_ocr_cache()
+    if cache is None:
+        return None, None, "vision_model"
+
+    with open(f"{cwd}/dataset/attachments/{image_path}", "rb") as image_file:
+        key = (
+            content_hash(image_file.read()),
+            os.environ["VISION_MODEL"],
+            ocr_version(),
+        )
+
+    text = cache.get(key)
+    if text is None:
+        return key, None, "vision_model"
+
+    logging.info("Tool", f"OCR cache hit for {image_path}")
+    return key, {"content": text, "usage": dict(NO_USAGE)}, "ocr_cache"
+
+
+def _prepare_ocr(image_path: str) -> tuple[Runnable, dict, ModelRouter, dict]:
+    """
+    Reads and preprocesses the image, returns the shared OCR chain with its
+    input, the router collecting the usage of the call and the image stats
+    """
+
+    file_path = f"{cwd}/dataset/attachments/{image_path}"
+
     logging.info(
         "Tool",
         f"""
@@ -39,47 +116,90 @@ def ocr_tool(image_path: str) -> str:
     """,
     )
 
-    encoded_img_string = ""
-    mime = magic.Magic(mime=True)
-    mime_type = mime.from_file(file_path)
+    resources = get_ocr_resources()
+    mime_type = resources.mime_type(file_path)
+
+    with open(file_path, "rb") as image_file:
+        image_data, mime_type, image_stats = prepare_image(image_file.read(), mime_type)
+        encoded_img_string = base64.b64encode(image_data).decode("utf-8")
+
+    if image_stats["bytes"] != image_stats["original_bytes"]:
+        logging.info(
+            "Tool",
+            f"Image {image_path}: {image_stats['original_bytes']} -> {image_stats['bytes']} bytes "
+            f"in {image_stats['prep_ms']:.1f} ms",
+        )
+
+    chain_input = {
+        "image": encoded_img_string,
+        "mime_type": mime_type,
+        "prompt": _ocr_prompt()[0],
+    }
+    return resources.chain, chain_input, ModelRouter(), image_stats
+
+
+def _ocr_config(router: ModelRouter) -> dict:
+    """
+    Runs the chain with the usage callback of the call only, the callbacks
+    of the calling graph are left out to keep the request from being counted
+    twice, as the usage is reported in the tool result
+    """
+    usage_handler = (
+        router.callback_handler
+        if get_ocr_resources().provider == "openai"
+        else router.ollama_callback_handler
+    )
+    return {"callbacks": [usage_handler]}
+
 
-    router = ModelRouter()
-    llm_model = router.get_model(
-        model_type=os.environ["VISION_MODEL"], temperature=0, is_vision=True
+def _is_pdf(image_path: str) -> bool:
+    return (
+        get_ocr_resources().mime_type(f"{cwd}/dataset/attachments/{image_path}")
+        == PDF_MIME_TYPE
     )
 
-    with open(file_path, "rb") as image_file:
-        model = llm_model["model"]
-        encoded_img_string = base64.b64encode(image_file.read()).decode("utf-8")
 
-    def invoker(data):
-        image = data["image"]
-        mime_type = data["mime_type"]
-        prompt = data["prompt"]
+def _pdf_ocr(image_path: str, router: ModelRouter) -> str:
+    """
+    Reads the text layer of the PDF pages, only the embedded images of
+    the pages without a text layer are sent to the vision model
+    """
+    logging.info("Tool", f"Read PDF {image_path}")
 
-        img_data_str = f"data:{mime_type};base64,{image}"
+    with open(f"{cwd}/dataset/attachments/{image_path}", "rb") as pdf_file:
+        pages = read_pdf_pages(pdf_file.read())
 
-        return [
-            HumanMessage(
-                content=[
+    resources = get_ocr_resources()
+    page_texts = []
+    for page_number, page in enumerate(pages, start=1):
+        texts = [page["text"]] if page["text"] else []
+        for image_data, mime_type in page["images"]:
+            image_data, mime_type, image_stats = prepare_image(image_data, mime_type)
+            start_time = time.perf_counter()
+            texts.append(
+                resources.chain.invoke(
                     {
-                        "type": "image_url",
-                        "image_url": (
-                            {"url": img_data_str}
-                            if llm_model["provider"] == "openai"
-                            else img_data_str
-                        ),
+                        "image": base64.b64encode(image_data).decode("utf-8"),
+                        "mime_type": mime_type,
+                        "prompt": OCR_PROMPT,
                     },
-                    {"type": "text", "text": prompt},
-                ]
+                    config=_ocr_config(router),
+                )
+            )
+            ocr_input_stats.record(
+                os.environ["VISION_MODEL"],
+                image_stats,
+                (time.perf_counter() - start_time) * 1000,
             )
-        ]
 
-    chain = invoker | model | StrOutputParser()
-    result = chain.invoke(
-        {"image": encoded_img_string, "mime_type": mime_type, "prompt": ocr_prompt}
-    )
+        if texts:
+            page_texts.append(f"Page {page_number}:\n" + "\n".join(texts))
+    return "\n\n".join(page_texts)
+
 
+def _ocr_result(
+    result: str, router: ModelRouter, cache_key: tuple = None, is_pdf: bool = False
+) -> dict:
     logging.info(
         "Tool",
         f"""
@@ -87,4 +207,85 @@ def ocr_tool(image_path: str) -> str:
         """,
     )
 
+    # the pages of a PDF are transcribed whatever the OCR mode
+    if ocr_mode() == "structured" and not is_pdf:
+        try:
+            # only the validated fields are passed on to the graph
+            result = parse_invoice_fields(result).model_dump_json(exclude_none=True)
+        except ValueError as e:
+            logging.error("Tool", f"OCR fields do not match the schema: {e}")
+            return {"content": result, "usage": router.check_usage()}
+
+    if cache_key is not None:
+        get_ocr_cache().put(cache_key, result)
+
     return {"content": result, "usage": router.check_usage()}
+
+
+def run_ocr(image_path: str) -> str:
+    """OCR tools parse invoice images to produce useful data for reconciliation"""
+    with span("ocr_tool", "tool", image_path=image_path) as tool_span:
+        # duplicates share the OCR result of their canonical attachment
+        image_path = get_canonical_attachment(
+            f"{get_db_path()}/emails.db", image_path
+        )
+        cache_key, stored_result, source = _stored_ocr(image_path)
+        if tool_span is not None:
+            tool_span["attributes"]["source"] = source
+        if stored_result is not None:
+            return stored_result
+
+        if _is_pdf(image_path):
+            router = ModelRouter()
+            result = _pdf_ocr(image_path, router)
+            return _ocr_result(result, router, cache_key, is_pdf=True)
+
+        chain, chain_input, router, image_stats = _prepare_ocr(image_path)
+        start_time = time.perf_counter()
+        result = chain.invoke(chain_input, config=_ocr_config(router))
+        ocr_input_stats.record(
+            os.environ["VISION_MODEL"],
+            image_stats,
+            (time.perf_counter() - start_time) * 1000,
+        )
+        return _ocr_result(result, router, cache_key)
+
+
+async def arun_ocr(image_path: str) -> str:
+    """OCR tools parse invoice images to produce useful data for reconciliation"""
+    with span("ocr_tool", "tool", image_path=image_path) as tool_span:
+        # reading the image and the stored texts are blocking
+        image_path = await asyncio.to_thread(
+            get_canonical_attachment, f"{get_db_path()}/emails.db", image_path
+        )
+        cache_key, stored_result, source = await asyncio.to_thread(
+            _stored_ocr, image_path
+        )
+        if tool_span is not None:
+            tool_span["attributes"]["source"] = source
+        if stored_result is not None:
+            return stored_result
+
+        if await asyncio.to_thread(_is_pdf, image_path):
+            router = ModelRouter()
+            result = await asyncio.to_thread(_pdf_ocr, image_path, router)
+            return await asyncio.to_thread(
+                _ocr_result, result, router, cache_key, True
+            )
+
+        chain, chain_input, router, image_stats = await asyncio.to_thread(
+            _prepare_ocr, image_path
+        )
+        start_time = time.perf_counter()
+        result = await chain.ainvoke(chain_input, config=_ocr_config(router))
+        ocr_input_stats.record(
+            os.environ["VISION_MODEL"],
+            image_stats,
+            (time.perf_counter() - start_time) * 1000,
+        )
+        return await asyncio.to_thread(_ocr_result, result, router, cache_key)
+
+
+ocr_tool = StructuredTool.from_function(
+    func=run_ocr, coroutine=arun_ocr, name="ocr_tool"
+)
@@ -3,14 +3,18 @@ Tool set for the agent who is in
 charge of parsing the emails
 """
 
+import asyncio
 import os
 import sqlite3
 
-from langchain.tools import tool
+from langchain_core.tools import StructuredTool
 
 from src.misc.beautified_logging import BeautifiedLogging
+from src.data.db.connection_pool import get_connection
 from src.data.db.db_scripts import query_sqlite_db
+from src.data.db.invoice_index import get_invoice_index
 from src.misc.path_parser import get_db_path
+from src.misc.tracing import span
 
 cwd = os.getcwd()
 
@@ -18,69 +22,159 @@ logging = BeautifiedLogging()
 
 TABLE_NAME = "transactions"
 
+INVOICE_COLUMNS = [
+    "invoice_id",
+    "bank_name",
+    "transaction_id",
+    "amount",
+    "recipient_name",
+    "sender_name",
+]
 
-@tool
-def invoice_db_query_tool(invoice_id: str) -> str:
+
+def query_invoice(invoice_id: str) -> str:
     """
     Search for transaction data in the invoice
     """
 
-    db_path = get_db_path()
+    with span("invoice_db_query_tool", "tool", invoice_id=invoice_id):
+        db_path = get_db_path()
+
+        logging.info(
+            "Tool",
+            f"""
+            Query Invoice ID: {invoice_id}
+            """,
+        )
+
+        try:
+            invoice_index = get_invoice_index(f"{db_path}/{TABLE_NAME}.db")
+            if invoice_index is not None:
+                result = invoice_index.lookup(invoice_id, INVOICE_COLUMNS)
+            else:
+                result = query_sqlite_db(
+                    f"{db_path}/{TABLE_NAME}.db",
+                    f"SELECT {', '.join(INVOICE_COLUMNS)} FROM {TABLE_NAME} WHERE invoice_id = ?",
+                    throw=True,
+                    parameters=(invoice_id,),
+                    read_only=True,
+                )
 
-    logging.info(
-        "Tool",
-        f"""
-        Query Invoice ID: {invoice_id}
-        """,
+            logging.info(
+                "Tool",
+                f"""
+                Query result:
+            
+                {result}
+                """,
+            )
+
+            if not result:
+                return {"content": "No results"}
+
+            parsed_results = ""
+            for index, header in enumerate(INVOICE_COLUMNS):
+                result_data = result[0][index]
+                formatted_data = result_data
+                if "amount" in header:
+                    formatted_data = f"${format(result_data, ',.2f')}"
+
+                parsed_results += f"{header}: { formatted_data }"
+            return {"content": parsed_results}
+
+        except sqlite3.Error as e:
+            logging.info("Tool", f"Query error: {e}")
+            return {
+                "content": "ERROR: Query failed. Please rewrite your query and try again."
+            }
+
+
+def query_invoices(invoice_ids: list[str]) -> str:
+    """
+    Search for the transaction data of several invoices at once
+    by providing the list of invoice IDs in the parameter
+
+    Every transaction matching an invoice ID is returned, one per line
+    """
+    # the order of the request is kept, repeated ids are queried once
+    invoice_ids = list(
+        dict.fromkeys(str(invoice_id).strip() for invoice_id in invoice_ids)
     )
 
-    try:
-        result = query_sqlite_db(
-            f"{db_path}/{TABLE_NAME}.db",
-            f"SELECT invoice_id, bank_name, transaction_id,amount, recipient_name, sender_name FROM {TABLE_NAME} WHERE invoice_id = '{invoice_id}'",
-            throw=True,
-        )
+    with span("invoice_db_batch_query_tool", "tool", invoice_ids=",".join(invoice_ids)):
+        db_path = get_db_path()
 
         logging.info(
             "Tool",
             f"""
-            Query result:
-            
-            {result}
+            Query Invoice IDs: {", ".join(invoice_ids)}
             """,
         )
 
-        if not result:
+        if not invoice_ids:
             return {"content": "No results"}
 
-        headers = [
-            "invoice_id",
-            "bank_name",
-            "transaction_id",
-            "amount",
-            "recipient_name",
-            "sender_name"
-        ]
-
-        parsed_results = ""
-        for index, header in enumerate(headers):
-            result_data = result[0][index]
-            formatted_data = result_data
-            if "amount" in header:
-                formatted_data = f"${format(float(result_data), ',.2f')}"
-
-            parsed_results += f"{header}: { formatted_data }"
-        return {"content": parsed_results}
-
-    except sqlite3.Error as e:
-        logging.info("Tool", f"Query error: {e}")
-        return {
-            "content": "ERROR: Query failed. Please rewrite your query and try again."
-        }
-
-
-@tool
-def invoice_db_update_tool(invoice_id: str, email_details: str) -> str:
+        try:
+            invoice_index = get_invoice_index(f"{db_path}/{TABLE_NAME}.db")
+            if invoice_index is not None:
+                result = [
+                    row
+                    for invoice_id in invoice_ids
+                    for row in invoice_index.lookup(invoice_id, INVOICE_COLUMNS)
+                ]
+            else:
+                result = query_sqlite_db(
+                    f"{db_path}/{TABLE_NAME}.db",
+                    f"""
+                    SELECT {", ".join(INVOICE_COLUMNS)} FROM {TABLE_NAME}
+                    WHERE invoice_id IN ({", ".join(["?" for _ in invoice_ids])})
+                    """,
+                    throw=True,
+                    parameters=invoice_ids,
+                    read_only=True,
+                )
+
+            logging.info(
+                "Tool",
+                f"""
+                Query result:
+
+                {result}
+                """,
+            )
+
+            # rows in the order of the requested ids, duplicated ids included
+            rows_by_id = {}
+            for row in result:
+                rows_by_id.setdefault(row[0], []).append(row)
+
+            lines = []
+            for invoice_id in invoice_ids:
+                for row in rows_by_id.get(invoice_id, []):
+                    lines.append(
+                        ", ".join(
+                            f"{header}: ${value:,.2f}"
+                            if header == "amount"
+                            else f"{header}: {value}"
+                            for header, value in zip(INVOICE_COLUMNS, row)
+                        )
+                    )
+
+            missing = [
+                invoice_id for invoice_id in invoice_ids if invoice_id not in rows_by_id
+            ]
+            if missing:
+                lines.append(f"No results for invoice_id: {', '.join(missing)}")
+            return {"content": "\n".join(lines)}
+
+        except sqlite3.Error as e:
+            logging.info("Tool", f"Query error: {e}")
+            return {
+                "content": "ERROR: Query failed. Please rewrite your query and try again."
+            }
+
+
+def update_invoice(invoice_id: str, email_details: str) -> str:
     """
     Updates transaction data in the table
     by providing invoice_id and email_details
@@ -89,42 +183,89 @@ def invoice_db_update_tool(invoice_id: str, email_details: str) -> str:
     The reconciliation_state column will be set to PAID
     """
 
-    db_path = get_db_path()
+    with span("invoice_db_update_tool", "tool", invoice_id=invoice_id):
+        db_path = get_db_path()
 
-    logging.info(
-        "Tool",
-        f"""
-        Update table:
+        logging.info(
+            "Tool",
+            f"""
+            Update table:
         
-        {invoice_id}: {email_details}
-        """,
-    )
+            {invoice_id}: {email_details}
+            """,
+        )
+
+        try:
+            # the invoice index writes through to the database
+            invoice_index = get_invoice_index(f"{db_path}/{TABLE_NAME}.db")
+            if invoice_index is not None:
+                with span("update_invoice", "db", db="transactions.db"):
+                    invoice_index.update(invoice_id, f"{email_details}")
+                logging.info("Tool", "Update success")
+                return {"content": "DONE"}
+
+            # pooled connection of the thread, kept open between the calls
+            conn = get_connection(f"{db_path}/transactions.db")
+
+            # Create the SQL update query
+            sql_query = f"""
+            UPDATE {TABLE_NAME}
+            SET reconciliation_state = 'PAID', email_details = ?
+            WHERE invoice_id = ?
+            """
+
+            # Execute the query with the provided values, committed on exit
+            with span("update_invoice", "db", db="transactions.db"), conn:
+                conn.execute(sql_query, (f"{email_details}", invoice_id))
+
+            logging.info("Tool", "Update success")
+            return {"content": "DONE"}
+        except sqlite3.Error as e:
+            logging.info("Tool", f"Update error: {e}")
+            return {
+                "content": "ERROR: Query failed. Please rewrite your query and try again."
+            }
+
+
+async def aquery_invoice(invoice_id: str) -> str:
+    """
+    Search for transaction data in the invoice
+    """
+    # sqlite3 is blocking, so the query runs off the event loop
+    return await asyncio.to_thread(query_invoice, invoice_id)
+
+
+async def aquery_invoices(invoice_ids: list[str]) -> str:
+    """
+    Search for the transaction data of several invoices at once
+    by providing the list of invoice IDs in the parameter
+
+    Every transaction matching an invoice ID is returned, one per line
+    """
+    return await asyncio.to_thread(query_invoices, invoice_ids)
+
+
+async def aupdate_invoice(invoice_id: str, email_details: str) -> str:
+    """
+    Updates transaction data in the table
+    by providing invoice_id and email_details
+    in the parameter
+
+    The reconciliation_state column will be set to PAID
+    """
+    return await asyncio.to_thread(update_invoice, invoice_id, email_details)
+
+
+invoice_db_query_tool = StructuredTool.from_function(
+    func=query_invoice, coroutine=aquery_invoice, name="invoice_db_query_tool"
+)
+
+invoice_db_batch_query_tool = StructuredTool.from_function(
+    func=query_invoices,
+    coroutine=aquery_invoices,
+    name="invoice_db_batch_query_tool",
+)
 
-    try:
-        conn = sqlite3.connect(f"{db_path}/transactions.db")
-        cursor = conn.cursor()
-
-        # Create the SQL update query
-        sql_query = f"""
-        UPDATE {TABLE_NAME}
-        SET reconciliation_state = 'PAID', email_details = ?
-        WHERE invoice_id = '{invoice_id}'
-        """
-
-        # Execute the query with the provided values
-        cursor.execute(sql_query, (f"{email_details}",))
-
-        # Commit the changes
-        conn.commit()
-
-        logging.info("Tool", "Update success")
-        return {"content": "DONE"}
-    except sqlite3.Error as e:
-        logging.info("Tool", f"Update error: {e}")
-        return {
-            "content": "ERROR: Query failed. Please rewrite your query and try again."
-        }
-    finally:
-        # Close the connection
-        if conn:
-            conn.close()
+invoice_db_update_tool = StructuredTool.from_function(
+    func=update_invoice, coroutine=aupdate_invoice, name="invoice_db_update_tool"
+)
@@ -9,31 +9,39 @@ from typing import Literal
 from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
 from langgraph.graph import StateGraph
 
+from src.llm.info.chatgpt_info import OpenAICallbackHandler
 from src.llm.models import ModelRouter
+from src.llm.langgraph.checkpoint import ThreadedSqliteSaver
 from src.llm.langgraph.routing import State
 
 
 class LangGraphQuery:
-    """Abstract class for RAG query. has standard method to save/retrieve/clear chat history"""
+    """
+    Abstract class for RAG query. has standard method to save/retrieve/clear chat history
+
+    The compiled graph and model clients are shared by every chat, only the
+    chat history and usage are kept per chat_id.
+
+    Every step of a chat is checkpointed under its chat_id, so a chat whose
+    run failed is resumed from the last completed node on its next run
+    """
 
     graph = None
     workflow = StateGraph(State)
 
-    def __init__(self):
+    def __init__(self, checkpoint_db_path: str = None):
         self.chat_history: dict[str, list[Literal[AIMessage, HumanMessage]]] = {}
 
         self.templates = {}
-        self.tool_usage = {
-            "successful_requests": 0,
-            "total_tokens": 0,
-            "prompt_tokens": 0,
-            "completion_tokens": 0,
-            "total_cost": 0,
-        }
+        self.tool_usage: dict[str, dict[str, int]] = {}
+        self.model_usage: dict[str, OpenAICallbackHandler] = {}
 
         self.workflow = StateGraph(State)
         self.model_router = ModelRouter()
 
+        # pass self.checkpointer when compiling the graph
+        self.checkpointer = ThreadedSqliteSaver(checkpoint_db_path or ":memory:")
+
     def get_llm_model(self, model_type: str = None, temperature: float = 0.8):
         """Get LLM model"""
         return self.model_router.get_model(
@@ -61,59 +69,146 @@ class LangGraphQuery:
         """Empty chat history"""
         self.chat_history[chat_id] = []
 
-    def accumulate_tool_usage(self, usage: dict[str, int]):
+    def release_chat(self, chat_id: str):
+        """Drop the chat history and usage of a finished chat"""
+        self.chat_history.pop(chat_id, None)
+        self.tool_usage.pop(chat_id, None)
+        self.model_usage.pop(chat_id, None)
+
+    def delete_checkpoints(self, chat_id: str):
+        """Drop the checkpoints of a chat, its next run starts from scratch"""
+        self.checkpointer.delete_thread(chat_id)
+
+    async def adelete_checkpoints(self, chat_id: str):
+        """Async version of delete_checkpoints"""
+        await self.checkpointer.adelete_thread(chat_id)
+
+    def accumulate_tool_usage(self, chat_id: str, usage: dict[str, int]):
         """Accumulate usage stats for tools"""
-        for key in self.tool_usage:
-            self.tool_usage[key] += usage.get(key, 0)
+        tool_usage = self.tool_usage.setdefault(
+            chat_id,
+            {
+                "successful_requests": 0,
+                "total_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_cost": 0,
+            },
+        )
+        for key in tool_usage:
+            tool_usage[key] += usage.get(key, 0)
+
+    def check_usage(self, chat_id: str) -> dict[str, int]:
+        """Check usage of a chat"""
+        total_usage = {
+            "successful_requests": 0,
+            "total_tokens": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_cost": 0,
+        }
 
-    def check_usage(self) -> dict[str, int]:
-        """Check usage"""
-        model_usages = self.model_router.check_usage()
-        total_usage = self.tool_usage
-        for key in self.tool_usage:
-            total_usage[key] += model_usages.get(key, 0)
+        tool_usage = self.tool_usage.get(chat_id, {})
+        model_usage = self.model_usage.get(chat_id)
+        for key in total_usage:
+            total_usage[key] += tool_usage.get(key, 0)
+            if model_usage is not None:
+                total_usage[key] += getattr(model_usage, key)
 
         return total_usage
 
-    def generate_response(self, query_text: str, chat_id: str):
-        """Generate response by running the required steps"""
+    def __graph_input(
+        self, query_text: str, chat_id: str
+    ) -> tuple[HumanMessage, dict, dict]:
+        """Initial query, graph input and run config of a chat"""
+
+        # model clients are shared, so usage is collected by a handler per chat
+        usage_handler = self.model_usage.setdefault(chat_id, OpenAICallbackHandler())
 
         init_query = HumanMessage(
             content=query_text, additional_kwargs={"sender": "requestor"}
         )
+        graph_input = {"messages": self.get_chat_history(chat_id) + [init_query]}
+        config = {
+            "recursion_limit": 150,
+            "callbacks": [usage_handler],
+            "configurable": {
+                # Checkpoints are accessed by thread_id
+                "thread_id": chat_id,
+            },
+        }
+        return init_query, graph_input, config
+
+    def __collect_event(
+        self, chat_id: str, event: dict, chat_data: list, response: str
+    ) -> str:
+        """Record the messages of a graph event and return the latest content"""
+        for value in event.values():
+            last_msg = value["messages"][-1]
+            last_msg.additional_kwargs = {
+                **last_msg.additional_kwargs,
+                "timestamp": datetime.now().isoformat(),
+            }
+            chat_data.append(last_msg)
+
+            if isinstance(last_msg, ToolMessage):
+                if last_msg.content.startswith("{"):
+                    try:
+                        tool_content = json.loads(last_msg.content)
+                        # get usage data if available
+                        usage = tool_content.get("usage", {})
+                        self.accumulate_tool_usage(chat_id=chat_id, usage=usage)
+                    except ValueError:
+                        print("json load error")
+
+            response = last_msg.content
+        return response
+
+    def generate_response(self, query_text: str, chat_id: str):
+        """
+        Generate response by running the required steps,
+        or resume the failed run of the chat from its last completed node
+        """
+
+        init_query, graph_input, config = self.__graph_input(query_text, chat_id)
         chat_data = [init_query]
+        state = self.graph.get_state(config)
+        if state.next:
+            graph_input = None
+            chat_data = []
+        elif state.values:
+            # a completed run left behind, i.e. after a crash before its
+            # checkpoints were dropped, the history is sent again instead
+            self.delete_checkpoints(chat_id)
+
         response = ""
-        for event in self.graph.stream(
-            {"messages": self.get_chat_history(chat_id) + [init_query]},
-            {
-                "recursion_limit": 150,
-                "configurable": {
-                    # Checkpoints are accessed by thread_id
-                    "thread_id": chat_id,
-                },
-            },
-        ):
-            for value in event.values():
-                last_msg = value["messages"][-1]
-                last_msg.additional_kwargs = {
-                    **last_msg.additional_kwargs,
-                    "timestamp": datetime.now().isoformat(),
-                }
-                chat_data.append(last_msg)
-
-                if isinstance(last_msg, ToolMessage):
-                    if last_msg.content.startswith("{"):
-                        try:
-                            tool_content = json.loads(last_msg.content)
-                            # get usage data if available
-                            usage = tool_content.get("usage", {})
-                            self.accumulate_tool_usage(usage=usage)
-                        except ValueError:
-                            print("json load error")
-
-                response = last_msg.content
-
-        # save chat history
-        self.save_chat_history(chat_id=chat_id, chat_msgs=chat_data)
+        try:
+            for event in self.graph.stream(graph_input, config):
+                response = self.__collect_event(chat_id, event, chat_data, response)
+        finally:
+            # save chat history, also of a failed run
+            self.save_chat_history(chat_id=chat_id, chat_msgs=chat_data)
+
+        return response
+
+    async def agenerate_response(self, query_text: str, chat_id: str):
+        """Async version of generate_response, runs the graph on the event loop"""
+
+        init_query, graph_input, config = self.__graph_input(query_text, chat_id)
+        chat_data = [init_query]
+        state = await self.graph.aget_state(config)
+        if state.next:
+            graph_input = None
+            chat_data = []
+        elif state.values:
+            await self.adelete_checkpoints(chat_id)
+
+        response = ""
+        try:
+            async for event in self.graph.astream(graph_input, config):
+                response = self.__collect_event(chat_id, event, chat_data, response)
+        finally:
+            # save chat history, also of a failed run
+            self.save_chat_history(chat_id=chat_id, chat_msgs=chat_data)
 
         return response
@@ -38,8 +38,9 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
         finance_clerk_model: str = None,
         vision_model: str = None,
         transaction_db_path: str = "",
+        checkpoint_db_path: str = None,
     ):
-        super().__init__()
+        super().__init__(checkpoint_db_path=checkpoint_db_path)
 
         self.supervisor_model = supervisor_model
         self.sql_model = sql_model
@@ -217,7 +218,8 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
         # add nodes and edges for admin clerk
         finance_clerk = self.__create_finance_clerk()
         self.workflow.add_node(
-            "finance_clerk", EmailReconAssistant(finance_clerk, "finance_clerk")
+            "finance_clerk",
+            EmailReconAssistant(finance_clerk, "finance_clerk").as_node(),
         )
         self.workflow.add_conditional_edges(
             "finance_clerk",
@@ -244,7 +246,9 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
         reconciliation_agent = self.__create_asst_agent()
         self.workflow.add_node(
             "senior_reconciliation_agent",
-            EmailReconAssistant(reconciliation_agent, "senior_reconciliation_agent"),
+            EmailReconAssistant(
+                reconciliation_agent, "senior_reconciliation_agent"
+            ).as_node(),
         )
         self.workflow.add_conditional_edges(
             "senior_reconciliation_agent",
@@ -260,7 +264,7 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
         data_engineer = self.__create_db_agent()
         self.workflow.add_node(
             "invoice_data_engineer",
-            EmailReconAssistant(data_engineer, "invoice_data_engineer"),
+            EmailReconAssistant(data_engineer, "invoice_data_engineer").as_node(),
         )
         self.workflow.add_conditional_edges(
             "invoice_data_engineer",
@@ -272,7 +276,9 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
         update_data_engineer = self.__create_db_update_agent()
         self.workflow.add_node(
             "invoice_update_data_engineer",
-            EmailReconAssistant(update_data_engineer, "invoice_update_data_engineer"),
+            EmailReconAssistant(
+                update_data_engineer, "invoice_update_data_engineer"
+            ).as_node(),
         )
         self.workflow.add_conditional_edges(
             "invoice_update_data_engineer",
@@ -282,4 +288,4 @@ class EmailReconInvoicingAssistant(LangGraphQuery):
 
         # add tools
         self.workflow.add_edge(START, "finance_clerk")
-        self.graph = self.workflow.compile()
+        self.graph = self.workflow.compile(checkpointer=self.checkpointer)
@@ -0,0 +1,60 @@
+"""
+Builds the invoicing assistants once per process so that
+the prompts, model clients, db reflection and compiled graph
+are reused across emails
+"""
+
+import threading
+
+from src.llm.langgraph.base import LangGraphQuery
+from src.llm.langgraph.email_recon.assistant import EmailReconInvoicingAssistant
+from src.llm.langgraph.tool_based_recon.assistant import (
+    ToolBasedEmailReconInvoicingAssistant,
+)
+
+_assistants: dict[tuple, LangGraphQuery] = {}
+_assistants_lock = threading.Lock()
+
+
+def get_invoicing_assistant(
+    supervisor_model: str = None,
+    sql_model: str = None,
+    finance_clerk_model: str = None,
+    vision_model: str = None,
+    transaction_db_path: str = "",
+    tool_based: bool = False,
+    checkpoint_db_path: str = None,
+) -> LangGraphQuery:
+    """
+    Get the shared invoicing assistant for the given configuration,
+    compiling it on first use
+
+    Per email state is kept by chat_id, call release_chat once the
+    results of a chat have been collected
+    """
+    key = (
+        tool_based,
+        supervisor_model,
+        sql_model,
+        finance_clerk_model,
+        vision_model,
+        transaction_db_path,
+        checkpoint_db_path,
+    )
+
+    with _assistants_lock:
+        if key not in _assistants:
+            assistant_class = (
+                ToolBasedEmailReconInvoicingAssistant
+                if tool_based
+                else EmailReconInvoicingAssistant
+            )
+            _assistants[key] = assistant_class(
+                supervisor_model=supervisor_model,
+                sql_model=sql_model,
+                finance_clerk_model=finance_clerk_model,
+                vision_model=vision_model,
+                transaction_db_path=transaction_db_path,
+                checkpoint_db_path=checkpoint_db_path,
+            )
+        return _assistants[key]
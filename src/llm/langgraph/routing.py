@@ -16,6 +16,7 @@ from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 
 from src.misc.beautified_logging import BeautifiedLogging
+from src.misc.tracing import span
 
 cwd = os.getcwd()
 
@@ -105,37 +106,74 @@ class LangGraphAssistant:
 
         return invoke_data
 
+    def __parse_result(self, result) -> AIMessage:
+        """Standardize the result of the runnable as a message from this agent"""
+        # handle sql agent executor results
+        if isinstance(result, dict):
+            output = result.get("output", "")
+            result = AIMessage(output)
+
+        result.additional_kwargs["sender"] = self.name
+        self.__log_msg(result)
+        return result
+
+    def __is_empty_result(self, result: AIMessage) -> bool:
+        return not result.tool_calls and (
+            not result.content
+            or isinstance(result.content, list)
+            and not result.content[0].get("text")
+        )
+
+    def __reprompt(self, state: State) -> State:
+        messages = state["messages"] + [HumanMessage("Respond with a real output.")]
+        return {**state, "messages": messages}
+
     def __call__(self, state: State, config: RunnableConfig):
         """When the data is redirected from another agent"""
-        while True:
-            parsed_info = self.__parse_chat_history(state["messages"])
-            # invoke AI
-            result = self.runnable.invoke(parsed_info)
-
-            # handle sql agent executor results
-            if isinstance(result, dict):
-                output = result.get("output", "")
-                result = AIMessage(output)
-
-            result.additional_kwargs["sender"] = self.name
-            self.__log_msg(result)
-
-            # If the LLM happens to return an empty response, we will re-prompt it
-            # for an actual response.
-            if not result.tool_calls and (
-                not result.content
-                or isinstance(result.content, list)
-                and not result.content[0].get("text")
-            ):
-                messages = state["messages"] + [
-                    HumanMessage("Respond with a real output.")
-                ]
-                state = {**state, "messages": messages}
-            else:
-                break
+        with span(self.name, "node") as node_span:
+            reprompts = 0
+            while True:
+                parsed_info = self.__parse_chat_history(state["messages"])
+                # invoke AI
+                result = self.__parse_result(self.runnable.invoke(parsed_info))
+
+                # If the LLM happens to return an empty response, we will re-prompt it
+                # for an actual response.
+                if self.__is_empty_result(result):
+                    state = self.__reprompt(state)
+                    reprompts += 1
+                else:
+                    break
+
+            if node_span is not None:
+                node_span["attributes"]["reprompts"] = reprompts
 
         return {"messages": state["messages"] + [result], "sender": self.name}
 
+    async def acall(self, state: State, config: RunnableConfig):
+        """Async version of __call__ for graphs run on an event loop"""
+        with span(self.name, "node") as node_span:
+            reprompts = 0
+            while True:
+                parsed_info = self.__parse_chat_history(state["messages"])
+                # invoke AI
+                result = self.__parse_result(await self.runnable.ainvoke(parsed_info))
+
+                if self.__is_empty_result(result):
+                    state = self.__reprompt(state)
+                    reprompts += 1
+                else:
+                    break
+
+            if node_span is not None:
+                node_span["attributes"]["reprompts"] = reprompts
+
+        return {"messages": state["messages"] + [result], "sender": self.name}
+
+    def as_node(self) -> RunnableLambda:
+        """Graph node supporting both the stream and astream execution of the graph"""
+        return RunnableLambda(self.__call__, afunc=self.acall, name=self.name)
+
 
 def handle_tool_error(state) -> dict:
     """Handle tool error"""
@@ -154,6 +192,18 @@ def handle_tool_error(state) -> dict:
 
 def create_tool_node_with_fallback(tools: list) -> dict:
     """When tool returns an error"""
-    return ToolNode(tools).with_fallbacks(
+    tool_node = ToolNode(tools).with_fallbacks(
         [RunnableLambda(handle_tool_error)], exception_key="error"
     )
+    # named like the graph nodes, i.e. call_ocr_tool
+    name = f"call_{'_'.join(tool.name for tool in tools)}"
+
+    def call_tools(state: State, config: RunnableConfig):
+        with span(name, "node"):
+            return tool_node.invoke(state, config)
+
+    async def acall_tools(state: State, config: RunnableConfig):
+        with span(name, "node"):
+            return await tool_node.ainvoke(state, config)
+
+    return RunnableLambda(call_tools, afunc=acall_tools, name=name)
@@ -11,7 +11,10 @@ from langchain_community.utilities.sql_database import SQLDatabase
 from langgraph.graph import START, END
 
 from src.llm.agents.email_agent.tools import ocr_tool
-from src.llm.agents.sql_agent.tools import invoice_db_query_tool, invoice_db_update_tool
+from src.llm.agents.sql_agent.tools import (
+    invoice_db_batch_query_tool,
+    invoice_db_update_tool,
+)
 from src.llm.langgraph.base import LangGraphQuery
 from src.llm.langgraph.routing import State, create_tool_node_with_fallback
 from src.llm.langgraph.tool_based_recon.builder import (
@@ -38,8 +41,9 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         finance_clerk_model: str = None,
         vision_model: str = None,
         transaction_db_path: str = "",
+        checkpoint_db_path: str = None,
     ):
-        super().__init__()
+        super().__init__(checkpoint_db_path=checkpoint_db_path)
 
         self.supervisor_model = supervisor_model
         self.sql_model = sql_model
@@ -66,7 +70,7 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
                     If the email and OCR data does not contain any information related to invoices,
                     respond with "NA" and the reason.
 
-                    Prefix "QUERY" and the invoice ID in your response to request for the invoices
+                    Prefix "QUERY" and all the invoice IDs in your response to request for the invoices
                     in our transaction database from the data engineer to check if the
                     invoice amount matches the database and the email.
 
@@ -105,8 +109,8 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
                     You are an Data Engineer working at the finance department.
                     You have access the invoice database
                     
-                    Your job is to query the database using the invoice_db_query_tool provided
-                    by passing the invoice ID as a parameter
+                    Your job is to query the database using the invoice_db_batch_query_tool provided
+                    by passing all the invoice IDs of the request as a list, in a single call
 
                     If the invoice ID is not provided, prefix your response with
                     "ASK" to request for the invoice ID
@@ -125,7 +129,7 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         )
         return data_engineer_prompt | self.get_llm_model(
             temperature=0.4, model_type=self.sql_model
-        )["model"].bind_tools([invoice_db_query_tool])
+        )["model"].bind_tools([invoice_db_batch_query_tool])
 
     def __create_db_update_agent(self) -> AgentExecutor:
         """Creates the db agent executor for the langgraph"""
@@ -186,7 +190,8 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         # add nodes and edges for admin clerk
         finance_clerk = self.__create_finance_clerk()
         self.workflow.add_node(
-            "finance_clerk", EmailReconAssistant(finance_clerk, "finance_clerk")
+            "finance_clerk",
+            EmailReconAssistant(finance_clerk, "finance_clerk").as_node(),
         )
         self.workflow.add_conditional_edges(
             "finance_clerk",
@@ -212,7 +217,9 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         reconciliation_agent = self.__create_asst_agent()
         self.workflow.add_node(
             "senior_reconciliation_agent",
-            EmailReconAssistant(reconciliation_agent, "senior_reconciliation_agent"),
+            EmailReconAssistant(
+                reconciliation_agent, "senior_reconciliation_agent"
+            ).as_node(),
         )
         self.workflow.add_conditional_edges(
             "senior_reconciliation_agent",
@@ -228,23 +235,23 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         data_engineer = self.__create_db_agent()
         self.workflow.add_node(
             "invoice_data_engineer",
-            EmailReconAssistant(data_engineer, "invoice_data_engineer"),
+            EmailReconAssistant(data_engineer, "invoice_data_engineer").as_node(),
         )
         self.workflow.add_conditional_edges(
             "invoice_data_engineer",
             db_agent_router,
             {
                 "senior_reconciliation_agent": "senior_reconciliation_agent",
-                "call_invoice_db_query_tool": "call_invoice_db_query_tool",
+                "call_invoice_db_batch_query_tool": "call_invoice_db_batch_query_tool",
             },
         )
         self.workflow.add_node(
-            "call_invoice_db_query_tool",
-            create_tool_node_with_fallback([invoice_db_query_tool]),
+            "call_invoice_db_batch_query_tool",
+            create_tool_node_with_fallback([invoice_db_batch_query_tool]),
         )
         # transaction query results will be passed to the reconciliation agent directly
         self.workflow.add_conditional_edges(
-            "call_invoice_db_query_tool",
+            "call_invoice_db_batch_query_tool",
             lambda x: x["sender"],
             {"invoice_data_engineer": "senior_reconciliation_agent"},
         )
@@ -253,7 +260,9 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
         update_data_engineer = self.__create_db_update_agent()
         self.workflow.add_node(
             "invoice_update_data_engineer",
-            EmailReconAssistant(update_data_engineer, "invoice_update_data_engineer"),
+            EmailReconAssistant(
+                update_data_engineer, "invoice_update_data_engineer"
+            ).as_node(),
         )
         self.workflow.add_conditional_edges(
             "invoice_update_data_engineer",
@@ -276,4 +285,4 @@ class ToolBasedEmailReconInvoicingAssistant(LangGraphQuery):
 
         # add tools
         self.workflow.add_edge(START, "finance_clerk")
-        self.graph = self.workflow.compile()
+        self.graph = self.workflow.compile(checkpointer=self.checkpointer)
@@ -55,7 +55,7 @@ def db_agent_router(
     last_message = messages[-1]
     if "tool_calls" in last_message.additional_kwargs:
         # The agent is invoking a tool
-        return "call_invoice_db_query_tool"
+        return "call_invoice_db_batch_query_tool"
     if "ERROR" in last_message.content:
         # When the SQL result has error, route back to the sql agent
         return "invoice_data_engineer"
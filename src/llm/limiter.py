@@ -0,0 +1,139 @@
+"""
+Per-backend concurrency caps for LLM requests
+"""
+
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable
+
+
+class BackendLimiter:
+    """
+    Caps the number of in-flight requests sent to a single LLM backend
+
+    The requests made from threads and from event loops share one count of
+    in-flight requests, a released slot is handed to the longest waiting
+    request, whether it waits in a thread or in any event loop
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+
+        self.__lock = threading.Lock()
+        self.__in_flight = 0
+        # wakes a waiting request, returns False when it cannot be woken
+        self.__waiters: deque[Callable[[], bool]] = deque()
+
+    def __try_acquire(self) -> bool:
+        """Take a free slot, call with the lock held"""
+        if self.__in_flight < self.max_concurrency and not self.__waiters:
+            self.__in_flight += 1
+            return True
+        return False
+
+    def __release(self):
+        with self.__lock:
+            # the slot passes to the next waiter without being freed
+            while self.__waiters:
+                if self.__waiters.popleft()():
+                    return
+            self.__in_flight -= 1
+
+    def __acquire(self):
+        event = threading.Event()
+        with self.__lock:
+            if self.__try_acquire():
+                return
+
+            def wake() -> bool:
+                event.set()
+                return True
+
+            self.__waiters.append(wake)
+        event.wait()
+
+    async def __aacquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result():
+            if not future.done():
+                future.set_result(None)
+
+        def wake() -> bool:
+            try:
+                loop.call_soon_threadsafe(set_result)
+            except RuntimeError:
+                # the loop of the waiter is closed
+                return False
+            return True
+
+        with self.__lock:
+            if self.__try_acquire():
+                return
+            self.__waiters.append(wake)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.__lock:
+                if wake in self.__waiters:
+                    self.__waiters.remove(wake)
+                    raise
+            # cancelled after the slot was handed over
+            self.__release()
+            raise
+
+    @contextmanager
+    def hold(self):
+        """Hold a request slot on the backend for the duration of the block"""
+        # a cap of 0 or less means the backend is not throttled
+        if self.max_concurrency <= 0:
+            yield
+            return
+
+        self.__acquire()
+        try:
+            yield
+        finally:
+            self.__release()
+
+    @asynccontextmanager
+    async def ahold(self):
+        """Async version of hold for requests made from the event loop"""
+        if self.max_concurrency <= 0:
+            yield
+            return
+
+        await self.__aacquire()
+        try:
+            yield
+        finally:
+            self.__release()
+
+
+_limiters: dict[str, BackendLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_backend_limiter(provider: str, base_url: str = None) -> BackendLimiter:
+    """
+    Get the shared limiter of a backend
+
+    Backends are identified by provider and base url, so models served from the
+    same endpoint share one cap. The cap is read from the <PROVIDER>_MAX_CONCURRENCY
+    environment variable, i.e. OLLAMA_MAX_CONCURRENCY or OPENAI_MAX_CONCURRENCY
+    """
+    key = f"{provider}:{base_url or ''}"
+
+    with _limiters_lock:
+        if key not in _limiters:
+            max_concurrency = int(
+                os.getenv(f"{provider.upper()}_MAX_CONCURRENCY", "0") or 0
+            )
+            _limiters[key] = BackendLimiter(name=key, max_concurrency=max_concurrency)
+        return _limiters[key]
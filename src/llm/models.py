@@ -10,6 +10,98 @@ from langchain_openai import ChatOpenAI
 
 from src.llm.info.chatgpt_info import OpenAICallbackHandler
 from src.llm.info.ollama_info import OllamaUsageCallbackHandler
+from src.llm.limiter import get_backend_limiter
+from src.misc.tracing import first_token, span, start_request
+
+
+class ThrottledChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI holding a backend slot for the duration of every request,
+    recorded as an llm span
+    """
+
+    def _generate(self, *args, **kwargs):
+        if self.streaming:
+            # goes through _stream, which holds the slot
+            return super()._generate(*args, **kwargs)
+
+        with span(self.model_name, "llm", provider="openai") as llm_span:
+            with get_backend_limiter("openai", self.openai_api_base).hold():
+                start_request(llm_span)
+                result = super()._generate(*args, **kwargs)
+                # the first token of a response that isn't streamed comes with the rest
+                first_token()
+                return result
+
+    async def _agenerate(self, *args, **kwargs):
+        if self.streaming:
+            return await super()._agenerate(*args, **kwargs)
+
+        with span(self.model_name, "llm", provider="openai") as llm_span:
+            async with get_backend_limiter("openai", self.openai_api_base).ahold():
+                start_request(llm_span)
+                result = await super()._agenerate(*args, **kwargs)
+                first_token()
+                return result
+
+    def _stream(self, *args, **kwargs):
+        with span(self.model_name, "llm", provider="openai") as llm_span:
+            with get_backend_limiter("openai", self.openai_api_base).hold():
+                start_request(llm_span)
+                for chunk in super()._stream(*args, **kwargs):
+                    first_token()
+                    yield chunk
+
+    async def _astream(self, *args, **kwargs):
+        with span(self.model_name, "llm", provider="openai") as llm_span:
+            async with get_backend_limiter("openai", self.openai_api_base).ahold():
+                start_request(llm_span)
+                async for chunk in super()._astream(*args, **kwargs):
+                    first_token()
+                    yield chunk
+
+
+class ThrottledChatOllama(ChatOllama):
+    """
+    ChatOllama holding a backend slot for the duration of every request,
+    recorded as an llm span
+    """
+
+    def _generate(self, *args, **kwargs):
+        with span(self.model, "llm", provider="ollama") as llm_span:
+            with get_backend_limiter("ollama", self.base_url).hold():
+                start_request(llm_span)
+                return super()._generate(*args, **kwargs)
+
+    async def _agenerate(self, *args, **kwargs):
+        with span(self.model, "llm", provider="ollama") as llm_span:
+            async with get_backend_limiter("ollama", self.base_url).ahold():
+                start_request(llm_span)
+                return await super()._agenerate(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        with span(self.model, "llm", provider="ollama") as llm_span:
+            with get_backend_limiter("ollama", self.base_url).hold():
+                start_request(llm_span)
+                yield from super()._stream(*args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        with span(self.model, "llm", provider="ollama") as llm_span:
+            async with get_backend_limiter("ollama", self.base_url).ahold():
+                start_request(llm_span)
+                async for chunk in super()._astream(*args, **kwargs):
+                    yield chunk
+
+    # ollama always streams its responses
+    def _create_chat_stream(self, *args, **kwargs):
+        for part in super()._create_chat_stream(*args, **kwargs):
+            first_token()
+            yield part
+
+    async def _acreate_chat_stream(self, *args, **kwargs):
+        async for part in super()._acreate_chat_stream(*args, **kwargs):
+            first_token()
+            yield part
 
 
 class ModelRouter:
@@ -55,13 +147,13 @@ class ModelRouter:
         if model_to_use["provider"] == "openai":
             return {
                 "provider": "openai",
-                "model": ChatOpenAI(
+                "model": ThrottledChatOpenAI(
                     **standard_params, callbacks=[self.callback_handler]
                 ),
             }
         return {
             "provider": "ollama",
-            "model": ChatOllama(
+            "model": ThrottledChatOllama(
                 **standard_params, callbacks=[self.ollama_callback_handler]
             ),
         }
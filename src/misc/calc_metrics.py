@@ -3,10 +3,10 @@ import sys
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 import pandas as pd
-from metrics import *
+from src.misc.metrics import *
 
 def print_usage():
-    print("Usage: python src/misc/calc_metrics.py <path_to_directory_containing_results> <platform>")
+    print("Usage: python -m src.misc.calc_metrics <path_to_directory_containing_results> <platform>")
 
 if len(sys.argv) < 3:
     print("Error: No directory path and/or platform provided.")
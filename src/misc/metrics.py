@@ -1,7 +1,8 @@
-import sqlite3
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from src.data.db.connection_pool import connect_read_only
+
 
 def plot_value_distribution(df2, col="category", top_n=10):
     df2[col].value_counts()[:top_n].plot(kind="bar")
@@ -56,7 +57,9 @@ def get_metrics(df, debug=False, including_df=False):
         print(df["process_status"].value_counts())
 
     vc = df["process_status"].value_counts()
-    completed = 1 - vc["NOT_STARTED"] / len(df) if "NOT_STARTED" in vc else 1
+    # emails claimed by a queue worker are still being processed
+    not_completed = vc.get("NOT_STARTED", 0) + vc.get("IN_PROGRESS", 0)
+    completed = 1 - not_completed / len(df)
 
     if debug:
         print(f"Task completion rate:\t\t{completed * 100:.2f}%")
@@ -109,7 +112,8 @@ def get_metrics(df, debug=False, including_df=False):
 
 
 def calculate_metrics(db_filepath, including_df=True, debug=False):
-    conn = sqlite3.connect(db_filepath)
+    # read-only, so a running reconciliation is never blocked by the metrics
+    conn = connect_read_only(db_filepath)
 
     # Write your SQL query
     query = "SELECT * FROM emails"
@@ -1,6 +1,6 @@
 import sys
 import os
-from metrics import calculate_metrics, get_metrics
+from src.misc.metrics import calculate_metrics, get_metrics
 
 
 def print_metrics(msg, metrics):
@@ -11,7 +11,7 @@ def print_metrics(msg, metrics):
 
 
 def print_usage():
-    print("Usage: python status.py <path_to_directory_containing_db>")
+    print("Usage: python -m src.misc.status <path_to_directory_containing_db>")
 
 
 if __name__ == "__main__":
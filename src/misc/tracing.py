@@ -0,0 +1,229 @@
+"""
+Span level tracing of the reconciliation runs
+
+Spans are recorded for the emails, the graph nodes, the LLM requests,
+the tool calls and the db queries, and saved to the spans table of a
+SQLite database and optionally to a JSON lines file.
+
+Tracing is off until configure_tracing is called, span is then a no-op
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from src.misc.beautified_logging import BeautifiedLogging
+
+logging = BeautifiedLogging()
+
+TABLE_NAME = "spans"
+
+SPAN_COLUMNS = {
+    "span_id": "TEXT PRIMARY KEY",
+    "trace_id": "TEXT",
+    "parent_id": "TEXT",
+    "name": "TEXT",
+    "kind": "TEXT",
+    "start_time": "REAL",
+    "end_time": "REAL",
+    "duration_ms": "REAL",
+    "queue_ms": "REAL",
+    "ttft_ms": "REAL",
+    "status": "TEXT",
+    "attributes": "TEXT",
+}
+
+# the span the current thread or task is in, copied by asyncio into the
+# tasks and asyncio.to_thread calls started from it, so nested spans find
+# their parent. Executor threads don't get it, the work submitted to them
+# runs in contextvars.copy_context() instead
+_current_span: ContextVar[Optional[dict[str, Any]]] = ContextVar(
+    "current_span", default=None
+)
+
+
+class SpanRecorder:
+    """
+    Buffers the finished spans and saves them in batches from a writer
+    thread, so the thread finishing a batch, i.e. the event loop, doesn't
+    wait for the database and the JSON lines file
+    """
+
+    def __init__(self, db_path: str, jsonl_path: str = None, flush_size: int = 200):
+        self.db_path = db_path
+        self.jsonl_path = jsonl_path
+        self.flush_size = flush_size
+
+        self.lock = threading.Lock()
+        self.spans: list[dict[str, Any]] = []
+        self.__queue: queue.Queue = queue.Queue()
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            columns = ", ".join(
+                f"{column} {column_type}"
+                for column, column_type in SPAN_COLUMNS.items()
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} ({columns})")
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {TABLE_NAME}_trace_id ON {TABLE_NAME} (trace_id)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.__thread = threading.Thread(
+            target=self.__run, name="span-writer", daemon=True
+        )
+        self.__thread.start()
+
+    def record(self, span: dict[str, Any]):
+        """Add a finished span, handing the buffer to the writer once it is full"""
+        with self.lock:
+            self.spans.append(span)
+            if len(self.spans) < self.flush_size:
+                return
+            spans, self.spans = self.spans, []
+        self.__queue.put(spans)
+
+    def flush(self):
+        """Save the buffered spans and wait for the writer"""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if spans:
+            self.__queue.put(spans)
+        self.__queue.join()
+
+    def close(self):
+        """Save the buffered spans and stop the writer thread"""
+        self.flush()
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            spans = self.__queue.get()
+            try:
+                if spans is None:
+                    return
+                self.__save(spans)
+            except Exception as e:
+                logging.error("Tracing", f"Failed to save {len(spans)} spans: {e!r}")
+            finally:
+                self.__queue.task_done()
+
+    def __save(self, spans: list[dict[str, Any]]):
+        rows = [
+            {
+                **{column: span.get(column) for column in SPAN_COLUMNS},
+                "attributes": json.dumps(span["attributes"], default=str),
+            }
+            for span in spans
+        ]
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                conn.executemany(
+                    f"""
+                    INSERT OR REPLACE INTO {TABLE_NAME} ({", ".join(SPAN_COLUMNS)})
+                    VALUES ({", ".join(["?" for _ in SPAN_COLUMNS])})
+                    """,
+                    [list(row.values()) for row in rows],
+                )
+        finally:
+            conn.close()
+
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a", encoding="utf-8") as jsonl_file:
+                for row in rows:
+                    jsonl_file.write(
+                        json.dumps({**row, "attributes": json.loads(row["attributes"])})
+                        + "\n"
+                    )
+
+
+_recorder: Optional[SpanRecorder] = None
+
+
+def configure_tracing(db_path: str, jsonl_path: str = None) -> SpanRecorder:
+    """Start recording spans to the spans table of db_path and to jsonl_path if set"""
+    global _recorder
+    _recorder = SpanRecorder(db_path=db_path, jsonl_path=jsonl_path)
+    return _recorder
+
+
+def close_tracing():
+    """Save the remaining spans and stop recording"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+@contextmanager
+def span(name: str, kind: str, trace_id: str = None, **attributes):
+    """
+    Record the block as a span of the given kind (email, node, llm, tool or db)
+
+    Spans without trace_id belong to the trace of their parent span
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield None
+        return
+
+    parent = _current_span.get()
+    current = {
+        "span_id": uuid.uuid4().hex[:16],
+        "trace_id": trace_id or (parent["trace_id"] if parent else None),
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "kind": kind,
+        "start_time": time.time(),
+        "status": "OK",
+        "attributes": attributes,
+    }
+    start = time.perf_counter()
+    current["_request_start"] = start
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current["status"] = "ERROR"
+        current["attributes"]["error"] = repr(e)
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # a span of a stream closed from another context, i.e. an
+            # abandoned async generator finalized by the event loop
+            pass
+        current["end_time"] = time.time()
+        current["duration_ms"] = (time.perf_counter() - start) * 1000
+        recorder.record(current)
+
+
+def start_request(current: Optional[dict[str, Any]]):
+    """Mark the end of the queue time of an LLM request span"""
+    if current is None:
+        return
+    now = time.perf_counter()
+    current["queue_ms"] = (now - current["_request_start"]) * 1000
+    current["_request_start"] = now
+
+
+def first_token():
+    """Mark the time to first token of the current LLM request span"""
+    current = _current_span.get()
+    if current is None or current["kind"] != "llm" or "ttft_ms" in current:
+        return
+    current["ttft_ms"] = (time.perf_counter() - current["_request_start"]) * 1000